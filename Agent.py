@@ -1,6 +1,8 @@
 import taichi as ti
 import taichi.math as tm
 import numpy as np
+import math
+import time
 
 import os
 import sys
@@ -13,26 +15,41 @@ parent_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
 sys.path.append(parent_directory)
 
 from utils.utils import vec2
+from field_layout import LAYOUTS, place_field, place_struct_field
+from snapshot import capture_state, restore_state
 
 
-@ti.dataclass
-class TrailAgent:
-    # basic attributes
-    from_node_ind: ti.i8
-    edge_indx: ti.i8
-    to_node_ind: ti.i8
-    pos: vec2
-    vel: ti.f32
-    acc: ti.f32
-    size: ti.f32
-    mass: ti.f32
+_trail_agent_structs = {}
 
-    # physical properties constrant
-    max_acc: ti.f32
-    max_spd: ti.f32
 
-    # charge
-    charge: ti.f32
+def trail_agent_struct(index_type):
+    """ TrailAgent struct storing its node / edge indices as index_type (use Trails.index_dtype) """
+    if index_type not in _trail_agent_structs:
+        @ti.dataclass
+        class TrailAgent:
+            # basic attributes
+            from_node_ind: index_type
+            edge_indx: index_type
+            to_node_ind: index_type
+            dist: ti.f32 # arc length travelled on the current edge
+            pos: vec2
+            vel: ti.f32
+            acc: ti.f32
+            size: ti.f32
+            mass: ti.f32
+
+            # physical properties constrant
+            max_acc: ti.f32
+            max_spd: ti.f32
+
+            # charge
+            charge: ti.f32
+
+        _trail_agent_structs[index_type] = TrailAgent
+    return _trail_agent_structs[index_type]
+
+
+TrailAgent = trail_agent_struct(ti.i32)
 
 
 @ti.dataclass
@@ -52,6 +69,30 @@ class FreeAgent:
     charge: ti.f32
 
 
+# default value of every FreeAgent member, in the order of the struct (bit order of fill_free_agents)
+FREE_AGENT_DEFAULTS = {
+    "pos": 0.0,
+    "vel": 0.0,
+    "acc": 0.0,
+    "size": 0.0,
+    "mass": 1.0,
+    "max_acc": 0.0,
+    "max_spd": 0.0,
+    "charge": 0.0,
+}
+
+
+@ti.func
+def hash_uniform(seed, i, j, k):
+    """ counter based random number in [0, 1), the same for the same (seed, i, j, k) on every backend """
+    h = ti.cast(seed, ti.u32) * ti.u32(747796405) + ti.cast(i, ti.u32) * ti.u32(2891336453)
+    h = (h ^ (h >> 16)) * ti.u32(2246822519) + ti.cast(j, ti.u32) * ti.u32(3266489917)
+    h = (h ^ (h >> 13)) * ti.u32(668265263) + ti.cast(k, ti.u32) * ti.u32(374761393)
+    h = (h ^ (h >> 16)) * ti.u32(2246822519)
+    h ^= h >> 13
+    return ti.cast(h >> 8, ti.f32) / 16777216.0
+
+
 @ti.data_oriented
 class SwarmAgents:
     def __init__(self,
@@ -70,45 +111,675 @@ class SwarmAgents:
                  front_size=None,
                  grid_n: int = 10,
                  simulation_size: float = 1.0,
-                 focus_number: int=6):
+                 focus_number: int=6,
+                 index_dtype=None,
+                 alignment_weight: float = 1.0,
+                 separation_weight: float = 1.0,
+                 cohesion_weight: float = 1.0,
+                 boundary: str = "wrap",
+                 layout: str = "agent_major_aos",
+                 seed=None,
+                 external_acc: bool = False):
         self.free_n = free_n
         self.trail_n = trail_n
         self.num_envs = num_envs
         self.grid_n = grid_n
         self.simulation_size = simulation_size # simulation size: [0,simulation_size]*[0,simulation_size]
+        if boundary not in ("wrap", "reflect"):
+            raise ValueError(f"unknown boundary: {boundary}")
+        self.boundary = boundary # "wrap": periodic borders, "reflect": agents bounce on the borders
         self.focus_number = focus_number
+        self.layout = layout # memory layout of the agent fields, one of field_layout.LAYOUTS
+        layout_args = LAYOUTS[self.layout]
+        # interaction radii of the alignment, separation and cohesion rules
+        self.alignment_size = alignment_size
+        self.separation_size = separation_size
+        self.cohesion_size = cohesion_size
+        self.alignment_weight = alignment_weight
+        self.separation_weight = separation_weight
+        self.cohesion_weight = cohesion_weight
+        # view cone of the topological (k nearest) neighbours, front_angle is the full opening angle in radians,
+        # None disables the cone / the range limit
+        self.front_angle = front_angle
+        self.front_size = front_size
+        self.limit_front_angle = front_angle is not None
+        self.limit_front_size = front_size is not None
         # initialize the free agents swarm
-        self.free_agents = FreeAgent.field(shape=(self.free_n, self.num_envs))
+        # double buffered state: steps read the committed buffer and write the other one, then swap
+        self.free_agents_buffers = [place_struct_field(FreeAgent, (self.free_n, self.num_envs), **layout_args),
+                                    place_struct_field(FreeAgent, (self.free_n, self.num_envs), **layout_args)]
+        self.committed = 0
         self.free_affect_number = ti.field(dtype=ti.i32,
-                                           shape=(self.n, self.num_envs, 3),
+                                           shape=(self.free_n, self.num_envs, 3),
                                            name="record of num of interaction agents") 
+        # rule vectors of each free agent, [:, :, 0]: alignment, [:, :, 1]: separation, [:, :, 2]: cohesion
+        self.free_rules = ti.Vector.field(2, dtype=ti.f32,
+                                          shape=(self.free_n, self.num_envs, 3),
+                                          name="alignment, separation and cohesion of free agents")
+
+        # cell list of the free agents on a grid_n * grid_n uniform grid, rebuilt every step,
+        # the agents of cell c in env j are cell_agents[cell_start[c, j]:cell_start[c, j] + cell_count[c, j], j]
+        self.cell_size = self.simulation_size / self.grid_n
+        # number of cell rings searched around an agent's cell, 1 (3x3 cells) when the radii fit in a cell
+        self.cell_reach = max(1, math.ceil(max(alignment_size, separation_size, cohesion_size) / self.cell_size))
+        self.cell_count = ti.field(dtype=ti.i32,
+                                   shape=(self.grid_n * self.grid_n, self.num_envs),
+                                   name="number of free agents in cells")
+        self.cell_start = ti.field(dtype=ti.i32,
+                                   shape=(self.grid_n * self.grid_n, self.num_envs),
+                                   name="first slot of cells in cell_agents")
+        self.cell_agents = place_field(ti.i32, (self.free_n, self.num_envs), layout_args["env_major"],
+                                       name="free agents sorted by cell")
+        self.agent_cell = ti.field(dtype=ti.i32,
+                                   shape=(self.free_n, self.num_envs, 2),
+                                   name="cell and rank in cell of free agents")
+
+        # focus_number nearest neighbours of each free agent sorted by distance, -1 for empty slots
+        self.focus_index = ti.field(dtype=ti.i32,
+                                    shape=(self.free_n, self.num_envs, self.focus_number),
+                                    name="nearest neighbours of free agents")
+        self.focus_dist = ti.field(dtype=ti.f32,
+                                   shape=(self.free_n, self.num_envs, self.focus_number),
+                                   name="squared distance of nearest neighbours")
         
-        self.init_field(self.free_agents.pos, pos)
-        self.init_field(self.free_agents.vel, vel)
-        self.init_field(self.free_agents.acc, acc)
-        self.init_field(self.free_agents.size, 0.0)
-        self.init_field(self.free_agents.mass, 1.0)
-        self.init_field(self.free_agents.max_acc, max_acc)
-        self.init_field(self.free_agents.max_spd, max_spd)
-        self.init_field(self.free_agents.alignment_size, alignment_size)
-        self.init_field(self.free_agents.separation_size, separation_size)
-        self.init_field(self.free_agents.cohesion_size, cohesion_size)
-        self.init_field(self.free_agents.front_angle, front_angle)
-        self.init_field(self.free_agents.front_size, front_size)
-
-        # initialize the trail agents swarm
-        self.trail_agents = TrailAgent.field(shape=(self.trail_n, self.num_envs))
+        # acceleration added to the flocking rules of every free agent (e.g. the actions of a controller),
+        # only allocated and read by flocking_step when external_acc is set
+        self.use_external_acc = external_acc
+        self.external_acc = None
+        if self.use_external_acc:
+            self.external_acc = ti.Vector.field(2, dtype=ti.f32, shape=(self.free_n, self.num_envs),
+                                                name="external acceleration of free agents")
+            self.external_acc.fill(0.0)
+
+        self.initialize({"pos": pos, "vel": vel, "acc": acc, "max_acc": max_acc, "max_spd": max_spd},
+                        seed=seed)
+
+        # initialize the trail agents swarm, indices are as wide as the trails they walk on
+        self.index_dtype = ti.i32 if index_dtype is None else index_dtype
+        # taichi fields can not be empty, one slot is kept when there is no trail agent
+        self.trail_agents = place_struct_field(trail_agent_struct(self.index_dtype),
+                                               (max(self.trail_n, 1), self.num_envs), **layout_args)
         self.trail_affect_number = ti.field(dtype=ti.i32,
-                                           shape=(self.n, self.num_envs, 3),
+                                           shape=(max(self.trail_n, 1), self.num_envs, 3),
                                            name="record of num of interaction agents")
+        # inputs of the "action" (index of the out edge taken at the next node) and "route" (target node) policies
+        self.trail_actions = ti.field(dtype=ti.i32,
+                                      shape=(max(self.trail_n, 1), self.num_envs),
+                                      name="out edge choice of trail agents")
+        self.trail_targets = ti.field(dtype=ti.i32,
+                                      shape=(max(self.trail_n, 1), self.num_envs),
+                                      name="target node of trail agents")
+        self.trail_step_count = 0 # seeds the random policy, one draw stream per step
+        # trail agents bucketed by edge (see update_edge_occupancy), allocated for the edges_num of the trails
+        self.edge_count = None
+        self.edge_start = None
+        self.edge_agents = None
+        self.dist_bucket_start = None
+        self.trail_leader = ti.field(dtype=ti.i32,
+                                     shape=(max(self.trail_n, 1), self.num_envs),
+                                     name="next trail agent ahead on the same edge")
+        self.trail_follower = ti.field(dtype=ti.i32,
+                                       shape=(max(self.trail_n, 1), self.num_envs),
+                                       name="next trail agent behind on the same edge")
+        self.trail_agent_slot = ti.field(dtype=ti.i32,
+                                         shape=(max(self.trail_n, 1), self.num_envs),
+                                         name="rank of trail agents on their edge")
+
+    def initialize(self, values=None, seed=None):
+        """ set every attribute of the free agents (committed buffer) at once
+
+            Args:
+                values: dict {member of FreeAgent: value} or numpy structured array whose field names are
+                        FreeAgent members, a value is either a scalar (broadcast on the device) or an array
+                        of shape (free_n, num_envs[, 2]), members not given (or None) keep their default
+                seed: if not None, the positions not given are drawn uniformly over the simulation area and
+                      the velocities not given get a random heading and a speed in [0, max_spd] on the device
+            Comments:
+                scalars and random values are written by one kernel launch, only arrays are copied from the host
+        """
+        if values is None:
+            values = {}
+        elif isinstance(values, np.ndarray):
+            values = {name: values[name] for name in values.dtype.names}
+        values = {name: value for name, value in values.items() if value is not None}
+        unknown = set(values) - set(FREE_AGENT_DEFAULTS)
+        if unknown:
+            raise ValueError(f"unknown free agent attributes: {sorted(unknown)}")
 
-    def init_field(self, property_field, property_value):
-        if property_value is not None:
-            if isinstance(property_value, np.ndarray):
-                property_field.from_numpy(property_value)
+        scalars = dict(FREE_AGENT_DEFAULTS)
+        arrays = {}
+        for name, value in values.items():
+            if np.ndim(value) == 0 or (name in ("pos", "vel", "acc") and np.shape(value) == (2,)):
+                scalars[name] = value
             else:
-                property_field.from_numpy(
-                    np.full(fill_value=property_value, dtype=np.float32, shape=(self.n, self.num_envs)))
+                arrays[name] = np.ascontiguousarray(value, dtype=np.float32)
+        scalars = {name: vec2(value) if name in ("pos", "vel", "acc") else value for name, value in scalars.items()}
+
+        # arrays are uploaded first, the kernel then keeps those members (random velocities may use max_spd)
+        for name, array in arrays.items():
+            getattr(self.free_agents, name).from_numpy(array)
+        keep = sum(1 << bit for bit, name in enumerate(FREE_AGENT_DEFAULTS) if name in arrays)
+        random_pos = seed is not None and "pos" not in values
+        random_vel = seed is not None and "vel" not in values
+        self.fill_free_agents(self.free_agents, FreeAgent(**scalars), keep,
+                              random_pos, random_vel, 0 if seed is None else seed)
+
+    @ti.kernel
+    def fill_free_agents(self, agents: ti.template(), agent: FreeAgent, keep: ti.i32,
+                         random_pos: ti.i32, random_vel: ti.i32, seed: ti.u32):
+        """ broadcast agent to every free agent, members whose bit (order of FREE_AGENT_DEFAULTS) is set
+            in keep are left as they are
+        """
+        for i, j in ti.ndrange(self.free_n, self.num_envs):
+            value = agent
+            old = agents[i, j]
+            if keep & 1:
+                value.pos = old.pos
+            if keep & 2:
+                value.vel = old.vel
+            if keep & 4:
+                value.acc = old.acc
+            if keep & 8:
+                value.size = old.size
+            if keep & 16:
+                value.mass = old.mass
+            if keep & 32:
+                value.max_acc = old.max_acc
+            if keep & 64:
+                value.max_spd = old.max_spd
+            if keep & 128:
+                value.charge = old.charge
+            if random_pos:
+                value.pos = vec2(hash_uniform(seed, i, j, 0), hash_uniform(seed, i, j, 1)) * self.simulation_size
+            if random_vel:
+                angle = 2 * tm.pi * hash_uniform(seed, i, j, 2)
+                value.vel = vec2(ti.cos(angle), ti.sin(angle)) * value.max_spd * hash_uniform(seed, i, j, 3)
+            agents[i, j] = value
+
+    @ti.func
+    def cell_coord(self, pos):
+        return tm.clamp(ti.cast(ti.floor(pos / self.cell_size), ti.i32), 0, self.grid_n - 1)
+
+    @ti.func
+    def neighbour_cell(self, coord, dx, dy):
+        """ cell index at offset (dx, dy) from coord, -1 outside the grid,
+            with wrapped borders every cell is reached by one offset only
+        """
+        cell = -1
+        x = coord[0] + dx
+        y = coord[1] + dy
+        if ti.static(self.boundary == "wrap"):
+            low = -(self.grid_n // 2)
+            high = (self.grid_n - 1) // 2
+            if low <= dx <= high and low <= dy <= high:
+                cell = ((x + self.grid_n) % self.grid_n) * self.grid_n + (y + self.grid_n) % self.grid_n
+        elif 0 <= x < self.grid_n and 0 <= y < self.grid_n:
+            cell = x * self.grid_n + y
+        return cell
+
+    @ti.func
+    def min_offset(self, offset):
+        """ shortest offset between two agents, through the borders when they are wrapped """
+        if ti.static(self.boundary == "wrap"):
+            offset -= self.simulation_size * ti.round(offset / self.simulation_size)
+        return offset
+
+    @property
+    def free_agents(self):
+        """ committed state of the free agents """
+        return self.free_agents_buffers[self.committed]
+
+    @property
+    def next_free_agents(self):
+        return self.free_agents_buffers[1 - self.committed]
+
+    def swap_free_agents(self):
+        self.committed = 1 - self.committed
+
+    def snapshot(self):
+        """ copy of the full state of the fields and counters (see snapshot.capture_state) """
+        return capture_state(self)
+
+    def restore(self, state):
+        """ restore a state of snapshot / snapshot.read_state """
+        restore_state(self, state)
+
+    def build_neighbour_grid(self):
+        self.sort_into_cells(self.free_agents)
+
+    @ti.kernel
+    def sort_into_cells(self, agents: ti.template()):
+        """ counting sort of the free agents by cell: count, exclusive prefix sum per env, scatter """
+        for c, j in self.cell_count:
+            self.cell_count[c, j] = 0
+
+        for i, j in ti.ndrange(self.free_n, self.num_envs):
+            coord = self.cell_coord(agents[i, j].pos)
+            cell = coord[0] * self.grid_n + coord[1]
+            self.agent_cell[i, j, 0] = cell
+            self.agent_cell[i, j, 1] = ti.atomic_add(self.cell_count[cell, j], 1)
+
+        for j in range(self.num_envs):
+            start = 0
+            for c in range(self.grid_n * self.grid_n):
+                self.cell_start[c, j] = start
+                start += self.cell_count[c, j]
+
+        for i, j in ti.ndrange(self.free_n, self.num_envs):
+            cell = self.agent_cell[i, j, 0]
+            self.cell_agents[self.cell_start[cell, j] + self.agent_cell[i, j, 1], j] = i
+
+    @ti.func
+    def accumulate_rules(self, agents: ti.template(), i, j):
+        """ visit the free agents in the cells around agent i of env j
+
+            Returns:
+                alignment: mean velocity of the neighbours within alignment_size
+                separation: sum of (pos_i - pos_k) / |pos_i - pos_k| ** 2 over the neighbours within separation_size
+                cohesion: mean position of the neighbours within cohesion_size, relative to pos_i
+                counts: number of neighbours of the three rules
+        """
+        pos = agents[i, j].pos
+        alignment = vec2(0.0)
+        separation = vec2(0.0)
+        cohesion = vec2(0.0)
+        counts = ti.Vector([0, 0, 0])
+        coord = self.cell_coord(pos)
+        for dx, dy in ti.ndrange((-self.cell_reach, self.cell_reach + 1), (-self.cell_reach, self.cell_reach + 1)):
+            cell = self.neighbour_cell(coord, dx, dy)
+            if cell >= 0:
+                for slot in range(self.cell_start[cell, j], self.cell_start[cell, j] + self.cell_count[cell, j]):
+                    k = self.cell_agents[slot, j]
+                    if k != i:
+                        offset = self.min_offset(agents[k, j].pos - pos)
+                        dist = offset.norm()
+                        if dist < self.alignment_size:
+                            alignment += agents[k, j].vel
+                            counts[0] += 1
+                        if 0 < dist < self.separation_size:
+                            separation -= offset / (dist * dist)
+                            counts[1] += 1
+                        if dist < self.cohesion_size:
+                            cohesion += offset
+                            counts[2] += 1
+        if counts[0] > 0:
+            alignment /= counts[0]
+        if counts[2] > 0:
+            cohesion /= counts[2]
+        return alignment, separation, cohesion, counts
+
+    def compute_rules(self):
+        """ fill free_rules and free_affect_number, build_neighbour_grid has to be called before """
+        self.gather_rules(self.free_agents)
+
+    @ti.kernel
+    def gather_rules(self, agents: ti.template()):
+        for i, j in ti.ndrange(self.free_n, self.num_envs):
+            alignment, separation, cohesion, counts = self.accumulate_rules(agents, i, j)
+            self.free_rules[i, j, 0] = alignment
+            self.free_rules[i, j, 1] = separation
+            self.free_rules[i, j, 2] = cohesion
+            for r in ti.static(range(3)):
+                self.free_affect_number[i, j, r] = counts[r]
+
+    def update_neighbours(self):
+        self.build_neighbour_grid()
+        self.compute_rules()
+
+    @ti.func
+    def focus_sift_down(self, i, j, root, size):
+        """ restore the max heap on focus_dist[i, j, :size] below root """
+        while 2 * root + 1 < size:
+            child = 2 * root + 1
+            if child + 1 < size and self.focus_dist[i, j, child + 1] > self.focus_dist[i, j, child]:
+                child += 1
+            if self.focus_dist[i, j, child] <= self.focus_dist[i, j, root]:
+                break
+            self.focus_dist[i, j, root], self.focus_dist[i, j, child] = self.focus_dist[i, j, child], self.focus_dist[i, j, root]
+            self.focus_index[i, j, root], self.focus_index[i, j, child] = self.focus_index[i, j, child], self.focus_index[i, j, root]
+            root = child
+
+    @ti.func
+    def focus_push(self, i, j, k, dist2, size):
+        """ offer agent k to the bounded max heap of agent i, returns the new heap size """
+        if size < self.focus_number:
+            child = size
+            self.focus_dist[i, j, child] = dist2
+            self.focus_index[i, j, child] = k
+            while child > 0 and self.focus_dist[i, j, (child - 1) // 2] < self.focus_dist[i, j, child]:
+                parent = (child - 1) // 2
+                self.focus_dist[i, j, parent], self.focus_dist[i, j, child] = self.focus_dist[i, j, child], self.focus_dist[i, j, parent]
+                self.focus_index[i, j, parent], self.focus_index[i, j, child] = self.focus_index[i, j, child], self.focus_index[i, j, parent]
+                child = parent
+            size += 1
+        elif dist2 < self.focus_dist[i, j, 0]:
+            self.focus_dist[i, j, 0] = dist2
+            self.focus_index[i, j, 0] = k
+            self.focus_sift_down(i, j, 0, size)
+        return size
+
+    @ti.func
+    def in_view(self, agents: ti.template(), i, j, offset, dist2):
+        visible = True
+        if ti.static(self.limit_front_size):
+            visible = dist2 <= self.front_size ** 2
+        if ti.static(self.limit_front_angle):
+            heading = agents[i, j].vel
+            if visible and heading.norm() > 0 and dist2 > 0:
+                visible = heading.dot(offset) >= ti.cos(0.5 * self.front_angle) * heading.norm() * ti.sqrt(dist2)
+        return visible
+
+    def find_focus_neighbours(self):
+        """ focus_number nearest (visible) neighbours of every free agent,
+            the grid rings around the agent's cell are searched until no closer agent can be found,
+            build_neighbour_grid has to be called before
+        """
+        self.gather_focus_neighbours(self.free_agents)
+
+    @ti.func
+    def ring_offset(self, ring, n):
+        """ offset of the n-th of the 8 * ring cells on the border of the square ring around a cell
+            (the cell itself for ring 0)
+        """
+        side = n // ti.max(2 * ring, 1)
+        t = n % ti.max(2 * ring, 1) - ring
+        dx, dy = 0, 0
+        if side == 0:
+            dx, dy = t, -ring
+        elif side == 1:
+            dx, dy = ring, t
+        elif side == 2:
+            dx, dy = -t, ring
         else:
-            property_field.fill(0.0)
+            dx, dy = -ring, -t
+        return dx, dy
+
+    @ti.kernel
+    def gather_focus_neighbours(self, agents: ti.template()):
+        # the farthest ring holding cells: with wrapped borders the offsets stop at grid_n // 2
+        max_ring = self.grid_n - 1
+        if ti.static(self.boundary == "wrap"):
+            max_ring = self.grid_n // 2
+        if ti.static(self.limit_front_size):
+            max_ring = ti.min(max_ring, ti.cast(ti.ceil(self.front_size / self.cell_size), ti.i32) + 1)
+        for i, j in ti.ndrange(self.free_n, self.num_envs):
+            pos = agents[i, j].pos
+            coord = self.cell_coord(pos)
+            size = 0
+            ring = 0
+            while ring <= max_ring:
+                # only the cells on the border of the ring, the inner ones were searched before
+                for n in range(ti.max(8 * ring, 1)):
+                    dx, dy = self.ring_offset(ring, n)
+                    cell = self.neighbour_cell(coord, dx, dy)
+                    if cell >= 0:
+                        for slot in range(self.cell_start[cell, j], self.cell_start[cell, j] + self.cell_count[cell, j]):
+                            k = self.cell_agents[slot, j]
+                            offset = self.min_offset(agents[k, j].pos - pos)
+                            dist2 = offset.dot(offset)
+                            if k != i and self.in_view(agents, i, j, offset, dist2):
+                                size = self.focus_push(i, j, k, dist2, size)
+                # agents beyond this ring are at least ring * cell_size away
+                if size == self.focus_number and (ring * self.cell_size) ** 2 >= self.focus_dist[i, j, 0]:
+                    break
+                ring += 1
+
+            # heap sort to ascending distance, then mark the empty slots
+            end = size - 1
+            while end > 0:
+                self.focus_dist[i, j, 0], self.focus_dist[i, j, end] = self.focus_dist[i, j, end], self.focus_dist[i, j, 0]
+                self.focus_index[i, j, 0], self.focus_index[i, j, end] = self.focus_index[i, j, end], self.focus_index[i, j, 0]
+                self.focus_sift_down(i, j, 0, end)
+                end -= 1
+            for slot in range(size, self.focus_number):
+                self.focus_index[i, j, slot] = -1
+                self.focus_dist[i, j, slot] = tm.inf
+
+    @ti.func
+    def clamp_norm(self, vec, max_norm):
+        norm = vec.norm()
+        if norm > max_norm:
+            vec *= max_norm / norm
+        return vec
+
+    @ti.kernel
+    def flocking_step(self, src: ti.template(), dst: ti.template(), dt: ti.f32):
+        """ one pass per free agent: neighbour rules, steering, clamping, integration and borders,
+            neighbours are only read from src and every agent is written once to dst
+        """
+        for i, j in ti.ndrange(self.free_n, self.num_envs):
+            alignment, separation, cohesion, counts = self.accumulate_rules(src, i, j)
+            for r in ti.static(range(3)):
+                self.free_affect_number[i, j, r] = counts[r]
+
+            agent = src[i, j]
+            acc = self.separation_weight * separation + self.cohesion_weight * cohesion
+            if counts[0] > 0:
+                acc += self.alignment_weight * (alignment - agent.vel)
+            if ti.static(self.use_external_acc):
+                acc += self.external_acc[i, j]
+            agent.acc = self.clamp_norm(acc, agent.max_acc)
+            agent.vel = self.clamp_norm(agent.vel + agent.acc * dt, agent.max_spd)
+            agent.pos += agent.vel * dt
+
+            if ti.static(self.boundary == "wrap"):
+                agent.pos -= self.simulation_size * ti.floor(agent.pos / self.simulation_size)
+            else:
+                for d in ti.static(range(2)):
+                    if agent.pos[d] < 0:
+                        agent.pos[d] = -agent.pos[d]
+                        agent.vel[d] = -agent.vel[d]
+                    elif agent.pos[d] > self.simulation_size:
+                        agent.pos[d] = 2 * self.simulation_size - agent.pos[d]
+                        agent.vel[d] = -agent.vel[d]
+                agent.pos = tm.clamp(agent.pos, 0.0, self.simulation_size)
+            dst[i, j] = agent
+
+    def step(self, dt):
+        """ advance the free agents by dt: rebuild the neighbour grid, run the fused flocking kernel
+            from the committed buffer into the other one and commit it
+        """
+        self.build_neighbour_grid()
+        self.flocking_step(self.free_agents, self.next_free_agents, dt)
+        self.swap_free_agents()
+
+
+    def place_trail_agents(self, trails, seed=0, vel=0.0, max_spd=1.0, max_acc=1.0):
+        """ put every trail agent at a random point of a random edge of trails """
+        self.scatter_trail_agents(trails, seed, vel, max_spd, max_acc)
+
+    @ti.kernel
+    def scatter_trail_agents(self, trails: ti.template(), seed: ti.u32, vel: ti.f32, max_spd: ti.f32, max_acc: ti.f32):
+        for a, j in ti.ndrange(self.trail_n, self.num_envs):
+            edge = ti.min(ti.cast(hash_uniform(seed, a, j, 0) * trails.edges_num, ti.i32), trails.edges_num - 1)
+            dist = hash_uniform(seed, a, j, 1) * trails.edges[edge, j].line_length
+            self.trail_agents[a, j].edge_indx = ti.cast(edge, self.index_dtype)
+            self.trail_agents[a, j].from_node_ind = trails.edges[edge, j].s_node_idx
+            self.trail_agents[a, j].to_node_ind = trails.edges[edge, j].e_node_idx
+            self.trail_agents[a, j].dist = dist
+            self.trail_agents[a, j].pos = trails.pos_at_distance(edge, j, dist)
+            self.trail_agents[a, j].vel = vel
+            self.trail_agents[a, j].acc = 0.0
+            self.trail_agents[a, j].mass = 1.0
+            self.trail_agents[a, j].max_spd = max_spd
+            self.trail_agents[a, j].max_acc = max_acc
+
+    def step_trail_agents(self, trails, dt, policy="random", route_table=None, max_hops=8):
+        """ move the trail agents by arc length along the edges of trails
+
+            Args:
+                trails: Trails the agents are walking on
+                dt: time step, each agent moves by vel * dt after its acc is applied and clamped
+                policy: edge picked at the end of an edge among the out edges of the reached node,
+                        "random": uniform, "action": trail_actions[a, j]-th out edge (modulo the degree),
+                        "route": route_table[node, trail_targets[a, j], j], agents stop at their target
+                route_table: (nodes_num, nodes_num, env_num) field of the next edge index for "route",
+                             the shortest path table of trails (Trails.build_routes) when None
+                max_hops: maximum number of node transitions of an agent per step
+            Comments:
+                the distance left at a node is carried over to the next edge, agents stop at dead ends
+        """
+        if policy not in ("random", "action", "route"):
+            raise ValueError(f"unknown trail policy: {policy}")
+        if policy == "route" and route_table is None:
+            trails.build_routes()
+            route_table = trails.route_next_edge
+        self.advance_trail_agents(trails, dt, policy, self.trail_actions if route_table is None else route_table,
+                                  max_hops, self.trail_step_count)
+        self.trail_step_count += 1
+
+    @ti.func
+    def next_trail_edge(self, trails: ti.template(), policy: ti.template(), route_table: ti.template(),
+                        node, a, j, hop, seed):
+        """ out edge of node taken by trail agent a, -1 to stop at node """
+        edge = -1
+        degree = trails.out_degree(node, j)
+        if degree > 0:
+            if ti.static(policy == "random"):
+                k = ti.min(ti.cast(hash_uniform(seed, a, j, hop) * degree, ti.i32), degree - 1)
+                edge = trails.out_edge(node, k, j)
+            elif ti.static(policy == "action"):
+                edge = trails.out_edge(node, self.trail_actions[a, j] % degree, j)
+            else:
+                if node != self.trail_targets[a, j]:
+                    edge = route_table[node, self.trail_targets[a, j], j]
+        return edge
+
+    @ti.kernel
+    def advance_trail_agents(self, trails: ti.template(), dt: ti.f32, policy: ti.template(),
+                             route_table: ti.template(), max_hops: ti.i32, seed: ti.u32):
+        for a, j in ti.ndrange(self.trail_n, self.num_envs):
+            agent = self.trail_agents[a, j]
+            agent.acc = tm.clamp(agent.acc, -agent.max_acc, agent.max_acc)
+            agent.vel = tm.clamp(agent.vel + agent.acc * dt, 0.0, agent.max_spd)
+            edge = ti.cast(agent.edge_indx, ti.i32)
+            dist = agent.dist + agent.vel * dt
+            hop = 0
+            while dist >= trails.edges[edge, j].line_length and hop < max_hops:
+                node = ti.cast(trails.edges[edge, j].e_node_idx, ti.i32)
+                next_edge = self.next_trail_edge(trails, policy, route_table, node, a, j, hop, seed)
+                if next_edge < 0:
+                    # dead end or target reached: wait at the node
+                    dist = trails.edges[edge, j].line_length
+                    agent.vel = 0.0
+                    break
+                dist -= trails.edges[edge, j].line_length
+                edge = next_edge
+                hop += 1
+            dist = ti.min(dist, trails.edges[edge, j].line_length)
+            agent.edge_indx = ti.cast(edge, self.index_dtype)
+            agent.from_node_ind = trails.edges[edge, j].s_node_idx
+            agent.to_node_ind = trails.edges[edge, j].e_node_idx
+            agent.dist = dist
+            agent.pos = trails.pos_at_distance(edge, j, dist)
+            self.trail_agents[a, j] = agent
+
+
+    def update_edge_occupancy(self, trails):
+        """ bucket the trail agents by edge and sort them along it
+
+            Comments:
+                the agents on edge e of env j, from the start of the edge to its end, are
+                edge_agents[edge_start[e, j]:edge_start[e, j] + edge_count[e, j], j],
+                trail_leader / trail_follower give the next agent ahead / behind on the same edge (-1: none)
+        """
+        if self.edge_count is None or self.edge_count.shape[0] != trails.edges_num:
+            self.edge_count = ti.field(dtype=ti.i32, shape=(trails.edges_num, self.num_envs),
+                                       name="number of trail agents on edges")
+            self.edge_start = ti.field(dtype=ti.i32, shape=(trails.edges_num, self.num_envs),
+                                       name="first slot of edges in edge_agents")
+            self.edge_agents = ti.field(dtype=ti.i32, shape=(max(self.trail_n, 1), self.num_envs),
+                                        name="trail agents sorted by edge and distance")
+            self.dist_bucket_start = ti.field(dtype=ti.i32, shape=(max(self.trail_n, 1), self.num_envs),
+                                              name="first slot of distance buckets in edge_agents")
+        self.bucket_trail_agents(trails)
+
+    @ti.func
+    def dist_bucket(self, trails: ti.template(), a, j):
+        """ slot of the distance bucket of trail agent a of env j, an edge holding k agents is cut into k
+            buckets of equal length, which follow each other in edge_agents
+        """
+        e = ti.cast(self.trail_agents[a, j].edge_indx, ti.i32)
+        count = self.edge_count[e, j]
+        t = self.trail_agents[a, j].dist / ti.max(trails.edges[e, j].line_length, 1e-6)
+        return self.edge_start[e, j] + tm.clamp(ti.cast(t * count, ti.i32), 0, count - 1)
+
+    @ti.kernel
+    def bucket_trail_agents(self, trails: ti.template()):
+        # counting sort on (edge, quantized distance) then an insertion fix-up inside each edge, which only
+        # moves agents sharing a bucket: O(trail_n) for agents spread along their edges
+        for e, j in self.edge_count:
+            self.edge_count[e, j] = 0
+        for b, j in self.dist_bucket_start:
+            self.dist_bucket_start[b, j] = 0
+
+        for a, j in ti.ndrange(self.trail_n, self.num_envs):
+            ti.atomic_add(self.edge_count[ti.cast(self.trail_agents[a, j].edge_indx, ti.i32), j], 1)
+
+        for j in range(self.num_envs):
+            start = 0
+            for e in range(trails.edges_num):
+                self.edge_start[e, j] = start
+                start += self.edge_count[e, j]
+
+        for a, j in ti.ndrange(self.trail_n, self.num_envs):
+            self.trail_agent_slot[a, j] = ti.atomic_add(self.dist_bucket_start[self.dist_bucket(trails, a, j), j], 1)
+
+        for j in range(self.num_envs):
+            start = 0
+            for b in range(self.trail_n):
+                count = self.dist_bucket_start[b, j]
+                self.dist_bucket_start[b, j] = start
+                start += count
+
+        for a, j in ti.ndrange(self.trail_n, self.num_envs):
+            self.edge_agents[self.dist_bucket_start[self.dist_bucket(trails, a, j), j] + self.trail_agent_slot[a, j], j] = a
+
+        # order each edge by distance along it (agent index breaks ties), then link the neighbours
+        for e, j in self.edge_count:
+            start = self.edge_start[e, j]
+            end = start + self.edge_count[e, j]
+            for k in range(start + 1, end):
+                agent = self.edge_agents[k, j]
+                dist = self.trail_agents[agent, j].dist
+                m = k - 1
+                while m >= start:
+                    prev = self.edge_agents[m, j]
+                    prev_dist = self.trail_agents[prev, j].dist
+                    if prev_dist < dist or (prev_dist == dist and prev < agent):
+                        break
+                    self.edge_agents[m + 1, j] = prev
+                    m -= 1
+                self.edge_agents[m + 1, j] = agent
+            for k in range(start, end):
+                agent = self.edge_agents[k, j]
+                self.trail_agent_slot[agent, j] = k - start
+                self.trail_follower[agent, j] = self.edge_agents[k - 1, j] if k > start else -1
+                self.trail_leader[agent, j] = self.edge_agents[k + 1, j] if k + 1 < end else -1
+
+
+def benchmark_layouts(free_n, num_envs, steps=20, dt=0.01, **swarm_args):
+    """ time SwarmAgents.step with every field layout and report the fastest one on this machine
 
+        Returns:
+            name of the fastest layout and a dict of the seconds per step of each layout
+    """
+    rng = np.random.default_rng(0)
+    pos = rng.random((free_n, num_envs, 2), dtype=np.float32) * swarm_args.get("simulation_size", 1.0)
+    vel = rng.standard_normal((free_n, num_envs, 2), dtype=np.float32) * 0.1
+    timings = {}
+    for layout in LAYOUTS:
+        swarm = SwarmAgents(free_n, num_envs=num_envs, pos=pos, vel=vel, max_acc=1.0, max_spd=1.0,
+                            layout=layout, **swarm_args)
+        swarm.step(dt) # compile both buffer directions before timing
+        swarm.step(dt)
+        ti.sync()
+        start = time.perf_counter()
+        for _ in range(steps):
+            swarm.step(dt)
+        ti.sync()
+        timings[layout] = (time.perf_counter() - start) / steps
+        print(f"{layout}: {timings[layout] * 1e3:.3f} ms / step")
+    best = min(timings, key=timings.get)
+    print(f"fastest layout for free_n={free_n}, num_envs={num_envs}: {best}")
+    return best, timings
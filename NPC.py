@@ -12,6 +12,7 @@ parent_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
 sys.path.append(parent_directory)
 
 from utils.utils import vec2
+from field_layout import LAYOUTS, place_struct_field
 
 @ti.dataclass
 class NPC:
@@ -24,5 +25,6 @@ class NPC:
     attached_agent_id: ti.i32
 
 
-
-
+def npc_field(npc_n, num_envs, layout="agent_major_aos"):
+    """ NPC field of shape (npc_n, num_envs) stored with one of field_layout.LAYOUTS """
+    return place_struct_field(NPC, (npc_n, num_envs), **LAYOUTS[layout])
@@ -1,6 +1,7 @@
 import taichi as ti
 import taichi.math as tm
 import numpy as np
+import math
 
 import os
 import sys
@@ -13,6 +14,9 @@ parent_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
 sys.path.append(parent_directory)
 
 from utils.utils import vec2, interpolation_all
+from field_layout import LAYOUTS, place_field
+from sensors import MipPyramid
+from snapshot import capture_state, restore_state
 
 
 @ti.data_oriented
@@ -20,18 +24,35 @@ class Dynamic_maps:
     def __init__(self,
                  grid_n,
                  max_size,
-                 env_num):
+                 env_num,
+                 layout="agent_major_aos",
+                 mip_levels=0):
         self.grid_n = grid_n # n columns * n rows
         self.max_size = max_size
         self.grid_length = self.max_size / self.grid_n
         self.env_num = env_num
-        self.field_map = ti.field(dtype=ti.f32,
-                                  shape=(self.grid_n, self.grid_n, self.env_num),
-                                  name="dynamics field maps")
+        self.layout = layout # only the env_major part of field_layout.LAYOUTS applies to the maps
+        env_major = LAYOUTS[self.layout]["env_major"]
+        self.field_map = place_field(ti.f32, (self.grid_n, self.grid_n, self.env_num), env_major,
+                                     name="dynamics field maps")
 
-        self.bound_map = ti.field(dtype=ti.f32,
-                                  shape=(self.grid_n, self.grid_n, self.env_num),
-                                  name="dynamics field maps")
+        self.bound_map = place_field(ti.f32, (self.grid_n, self.grid_n, self.env_num), env_major,
+                                     name="dynamics field maps")
+        # optional 2x downsampled levels of field_map for wide area sensing (sensors.MapSensor.sample_area)
+        self.pyramid = MipPyramid(self.grid_n, self.env_num, mip_levels, env_major) if mip_levels > 0 else None
+
+    def update_pyramid(self, region=None):
+        """ rebuild the mip levels after field_map changed, region = (i0, j0, i1, j1) limits it to the changed cells """
+        if self.pyramid is not None:
+            self.pyramid.update(self.field_map, region)
+
+    def snapshot(self):
+        """ copy of the full state of the fields and counters (see snapshot.capture_state) """
+        return capture_state(self)
+
+    def restore(self, state):
+        """ restore a state of snapshot / snapshot.read_state """
+        restore_state(self, state)
     
     @ti.kernel
     def get_boung_map(self, input_maps: ti.template()):
@@ -49,19 +70,216 @@ class Dynamic_maps:
         pass
 
 
-# @ti.dataclass
-# class Diffusion:
-#     q_s: ti.f32 # release strength
-#     U: ti.f32 # average wind speed
-#     D: ti.f32 # isotropic diffusivity
-#     psi: ti.f32 # wind direction
-#     tau: ti.f32 # particle lifetime
-
-#     @ti.func
-#     def consentration(self, p, p_s, delta_t): # p: sensor position   p_s: plume source position   delta_t: duration time
-#         length = ti.length(p-p_s)
-#         lambda_symbol = ti.sqrt(self.D * self.tau/(1 + (self.U**2)*self.tau/(4*self.D)))
-#         delta_y = -(p[0]-p_s[0]) * tm.sin(self.psi) + (p[1]-p_s[1]) * tm.cos(self.psi)
-#         m = self.q_s/(4 * tm.pi * self.D * length) * tm.exp((-delta_y * self.U / (2 * self.D))+(-length * delta_t / lambda_symbol))
-#         # m: mean gas concentration at p
-#         return m
+@ti.dataclass
+class Diffusion:
+    q_s: ti.f32 # release strength
+    U: ti.f32 # average wind speed
+    D: ti.f32 # isotropic diffusivity
+    psi: ti.f32 # wind direction
+    tau: ti.f32 # particle lifetime
+
+    @ti.func
+    def consentration(self, p, p_s, delta_t): # p: sensor position   p_s: plume source position   delta_t: duration time
+        length = ti.max(tm.length(p-p_s), 1e-6)
+        lambda_symbol = ti.sqrt(self.D * self.tau/(1 + (self.U**2)*self.tau/(4*self.D)))
+        delta_y = -(p[0]-p_s[0]) * tm.sin(self.psi) + (p[1]-p_s[1]) * tm.cos(self.psi)
+        m = self.q_s/(4 * tm.pi * self.D * length) * tm.exp((-delta_y * self.U / (2 * self.D))+(-length * delta_t / lambda_symbol))
+        # m: mean gas concentration at p
+        return m
+
+
+@ti.data_oriented
+class DiffusionMap(Dynamic_maps):
+    def __init__(self,
+                 grid_n,
+                 max_size,
+                 env_num,
+                 diffusivity=0.1,
+                 wind=(0.0, 0.0),
+                 source_pos=(0.0, 0.0),
+                 source_strength=1.0,
+                 decay=0.0,
+                 scheme="explicit",
+                 safety=0.9,
+                 jacobi_iterations=20,
+                 free_threshold=None,
+                 layout="agent_major_aos",
+                 mip_levels=0):
+        """ gas concentration over the grid, advected by a uniform wind and diffused, released by a point source
+
+            Args:
+                diffusivity, wind, source_pos, source_strength, decay: scalars (vec2 for wind / source_pos)
+                    shared by all envs or arrays with one value per env, see set_params
+                scheme: "explicit": upwind advection + explicit diffusion, substeps bounded by both terms,
+                        "implicit": upwind advection + backward Euler diffusion solved by jacobi_iterations Jacobi
+                                    sweeps, substeps only bounded by the advection CFL number
+                safety: fraction of the largest stable substep that is used
+                free_threshold: cells whose bound_map is below it block the gas, None: bound_map is not used
+        """
+        super().__init__(grid_n, max_size, env_num, layout, mip_levels)
+        if scheme not in ("explicit", "implicit"):
+            raise ValueError(f"unknown diffusion scheme: {scheme}")
+        if jacobi_iterations < 1:
+            raise ValueError(f"jacobi_iterations must be at least 1, got {jacobi_iterations}")
+        self.scheme = scheme
+        self.safety = safety
+        self.jacobi_iterations = jacobi_iterations
+        self.use_walls = free_threshold is not None
+        self.free_threshold = 0.0 if free_threshold is None else free_threshold
+
+        env_major = LAYOUTS[self.layout]["env_major"]
+        # field_map is the committed state, steps write next_map and swap the two
+        self.next_map = place_field(ti.f32, (self.grid_n, self.grid_n, self.env_num), env_major,
+                                    name="next dynamics field maps")
+        self.jacobi_map = None
+        if self.scheme == "implicit":
+            self.jacobi_map = place_field(ti.f32, (self.grid_n, self.grid_n, self.env_num), env_major,
+                                          name="jacobi iterate of dynamics field maps")
+
+        self.plume = Diffusion.field(shape=(self.env_num,))
+        self.source_pos = ti.Vector.field(2, dtype=ti.f32, shape=(self.env_num,), name="plume source positions")
+        self.wind = ti.Vector.field(2, dtype=ti.f32, shape=(self.env_num,), name="wind velocity")
+        self.decay = ti.field(dtype=ti.f32, shape=(self.env_num,), name="decay rate")
+        self.set_params(diffusivity=diffusivity, wind=wind, source_pos=source_pos,
+                        source_strength=source_strength, decay=decay)
+        self.field_map.fill(0.0)
+
+    def set_params(self, diffusivity=None, wind=None, source_pos=None, source_strength=None, decay=None):
+        """ update the per env parameters, a scalar (vec2) is used for all envs, an array gives one per env """
+        def per_env(value, width=None):
+            shape = (self.env_num,) if width is None else (self.env_num, width)
+            return np.ascontiguousarray(np.broadcast_to(np.asarray(value, dtype=np.float32), shape))
+
+        if diffusivity is not None:
+            self.host_diffusivity = per_env(diffusivity)
+            self.plume.D.from_numpy(self.host_diffusivity)
+        if wind is not None:
+            self.host_wind = per_env(wind, 2)
+            self.wind.from_numpy(self.host_wind)
+            self.plume.U.from_numpy(np.linalg.norm(self.host_wind, axis=1).astype(np.float32))
+            self.plume.psi.from_numpy(np.arctan2(self.host_wind[:, 1], self.host_wind[:, 0]).astype(np.float32))
+        if source_pos is not None:
+            self.source_pos.from_numpy(per_env(source_pos, 2))
+        if source_strength is not None:
+            self.plume.q_s.from_numpy(per_env(source_strength))
+        if decay is not None:
+            self.host_decay = per_env(decay)
+            self.decay.from_numpy(self.host_decay)
+            # particle lifetime of the analytic plume
+            with np.errstate(divide="ignore"):
+                self.plume.tau.from_numpy(np.where(self.host_decay > 0, 1.0 / self.host_decay, 1e12).astype(np.float32))
+
+    def max_substep(self):
+        """ largest stable time step of the finite difference scheme over all envs """
+        dx = self.grid_length
+        advection = np.abs(self.host_wind).sum(axis=1).max() / dx
+        rate = advection
+        if self.scheme == "explicit":
+            rate = rate + (4 * self.host_diffusivity / dx ** 2 + self.host_decay).max()
+        return np.inf if rate <= 0 else 1.0 / rate
+
+    def dynamic_rule(self, h):
+        """ advance the concentration by h with as many equal substeps as the stability bound requires
+
+            Args:
+                h: float, describing the time interval
+        """
+        substeps = max(1, math.ceil(h / (self.safety * self.max_substep())))
+        dt = h / substeps
+        for _ in range(substeps):
+            if self.scheme == "explicit":
+                self.explicit_step(self.field_map, self.next_map, dt)
+                self.field_map, self.next_map = self.next_map, self.field_map
+            else:
+                # jacobi_map keeps the advected right hand side, the old state in field_map is
+                # no longer needed and serves as the second iterate buffer
+                self.advect_step(self.field_map, self.jacobi_map, dt)
+                iterate, spare = self.next_map, self.field_map
+                self.jacobi_step(self.jacobi_map, self.jacobi_map, iterate, dt)
+                for _ in range(self.jacobi_iterations - 1):
+                    self.jacobi_step(self.jacobi_map, iterate, spare, dt)
+                    iterate, spare = spare, iterate
+                self.field_map, self.next_map = iterate, spare
+        self.update_pyramid()
+        return substeps
+
+    @ti.func
+    def is_free(self, i, j, k):
+        free = True
+        if ti.static(self.use_walls):
+            free = self.bound_map[i, j, k] >= self.free_threshold
+        return free
+
+    @ti.func
+    def neighbour_value(self, src: ti.template(), i, j, k, di, dj):
+        """ value of the neighbour cell, the cell's own value at the grid borders and walls (no flux) """
+        ni = tm.clamp(i + di, 0, self.grid_n - 1)
+        nj = tm.clamp(j + dj, 0, self.grid_n - 1)
+        value = src[i, j, k]
+        if self.is_free(ni, nj, k):
+            value = src[ni, nj, k]
+        return value
+
+    @ti.func
+    def advection_source(self, src: ti.template(), i, j, k, dt):
+        """ src advected by one upwind step, plus the gas released in the source cell """
+        c = src[i, j, k]
+        wind = self.wind[k]
+        grad_x = c - self.neighbour_value(src, i, j, k, -1, 0)
+        if wind[0] < 0:
+            grad_x = self.neighbour_value(src, i, j, k, 1, 0) - c
+        grad_y = c - self.neighbour_value(src, i, j, k, 0, -1)
+        if wind[1] < 0:
+            grad_y = self.neighbour_value(src, i, j, k, 0, 1) - c
+        value = c - dt * (wind[0] * grad_x + wind[1] * grad_y) / self.grid_length
+        source = ti.cast(ti.floor(self.source_pos[k] / self.grid_length), ti.i32)
+        if source[0] == i and source[1] == j:
+            value += dt * self.plume[k].q_s / self.grid_length ** 2
+        return value
+
+    @ti.func
+    def laplacian_sum(self, src: ti.template(), i, j, k):
+        return self.neighbour_value(src, i, j, k, -1, 0) + self.neighbour_value(src, i, j, k, 1, 0) + \
+               self.neighbour_value(src, i, j, k, 0, -1) + self.neighbour_value(src, i, j, k, 0, 1)
+
+    @ti.kernel
+    def explicit_step(self, src: ti.template(), dst: ti.template(), dt: ti.f32):
+        for i, j, k in dst:
+            value = 0.0
+            if self.is_free(i, j, k):
+                c = src[i, j, k]
+                diffusion = self.plume[k].D * (self.laplacian_sum(src, i, j, k) - 4 * c) / self.grid_length ** 2
+                value = self.advection_source(src, i, j, k, dt) + dt * (diffusion - self.decay[k] * c)
+            dst[i, j, k] = ti.max(value, 0.0)
+
+    @ti.kernel
+    def advect_step(self, src: ti.template(), dst: ti.template(), dt: ti.f32):
+        for i, j, k in dst:
+            value = 0.0
+            if self.is_free(i, j, k):
+                value = self.advection_source(src, i, j, k, dt)
+            dst[i, j, k] = ti.max(value, 0.0)
+
+    @ti.kernel
+    def jacobi_step(self, rhs: ti.template(), src: ti.template(), dst: ti.template(), dt: ti.f32):
+        """ Jacobi sweep of (1 + dt * decay) c - dt * D * laplacian(c) = rhs, rhs is also the first iterate """
+        for i, j, k in dst:
+            value = 0.0
+            if self.is_free(i, j, k):
+                alpha = dt * self.plume[k].D / self.grid_length ** 2
+                value = (rhs[i, j, k] + alpha * self.laplacian_sum(src, i, j, k)) / (1 + dt * self.decay[k] + 4 * alpha)
+            dst[i, j, k] = value
+
+    def fill_analytic(self, delta_t):
+        """ closed form mean concentration of the plume of each env at the cell centers """
+        self.fill_plume(self.field_map, delta_t)
+        self.update_pyramid()
+
+    @ti.kernel
+    def fill_plume(self, dst: ti.template(), delta_t: ti.f32):
+        for i, j, k in dst:
+            value = 0.0
+            if self.is_free(i, j, k):
+                p = (vec2(i, j) + 0.5) * self.grid_length
+                value = self.plume[k].consentration(p, self.source_pos[k], delta_t)
+            dst[i, j, k] = value
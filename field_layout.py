@@ -0,0 +1,42 @@
+import taichi as ti
+
+# memory layouts of the (..., env) fields, the indexing stays field[..., env] for all of them:
+#   env_major=False: the env index varies fastest, the envs of one agent / cell are contiguous (default)
+#   env_major=True:  the env axis is the outermost one, the agents / cells of one env are contiguous
+#   soa=False: members of a struct are interleaved per element (array of structs, default)
+#   soa=True:  every struct member is stored in its own array (struct of arrays)
+LAYOUTS = {
+    "agent_major_aos": {"env_major": False, "soa": False},
+    "agent_major_soa": {"env_major": False, "soa": True},
+    "env_major_aos": {"env_major": True, "soa": False},
+    "env_major_soa": {"env_major": True, "soa": True},
+}
+
+
+def _dense(shape, env_major):
+    if not env_major:
+        return ti.root.dense(ti.axes(*range(len(shape))), shape)
+    env_axis = len(shape) - 1
+    return ti.root.dense(ti.axes(env_axis), shape[env_axis]).dense(ti.axes(*range(env_axis)), shape[:env_axis])
+
+
+def place_field(dtype, shape, env_major=False, name=None):
+    """ scalar field of shape (..., env_num) """
+    if not env_major:
+        return ti.field(dtype=dtype, shape=shape, name=name)
+    field = ti.field(dtype=dtype, name=name)
+    _dense(shape, env_major).place(field)
+    return field
+
+
+def place_struct_field(struct_type, shape, env_major=False, soa=False):
+    """ field of a ti.dataclass with shape (..., env_num) """
+    if not env_major:
+        return struct_type.field(shape=shape, layout=ti.Layout.SOA if soa else ti.Layout.AOS)
+    field = struct_type.field()
+    if soa:
+        for member in field.keys:
+            _dense(shape, env_major).place(getattr(field, member))
+    else:
+        _dense(shape, env_major).place(field)
+    return field
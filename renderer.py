@@ -0,0 +1,279 @@
+import taichi as ti
+import taichi.math as tm
+import numpy as np
+import json
+
+
+# images are (envs, H, W) fields of rgb u8, row 0 is the top of the image, pixel (r, c) shows the point
+# (c + 0.5) / W, 1 - (r + 0.5) / H of the unit square (the ti.GUI coordinates)
+FRAME_FORMATS = ("npz", "raw")
+
+
+def rgb(color):
+    """ 0xRRGGBB -> (r, g, b) """
+    return ((color >> 16) & 0xff, (color >> 8) & 0xff, color & 0xff)
+
+
+@ti.func
+def stamp_disc(image: ti.template(), k, p, radius, color):
+    """ fill the pixels of image[k] within radius pixels of the unit square point p """
+    h, w = image.shape[1], image.shape[2]
+    c0 = ti.cast(p[0] * w, ti.i32)
+    r0 = ti.cast((1 - p[1]) * h, ti.i32)
+    for dr, dc in ti.ndrange((-radius, radius + 1), (-radius, radius + 1)):
+        r, c = r0 + dr, c0 + dc
+        if dr * dr + dc * dc <= radius * radius and 0 <= r < h and 0 <= c < w:
+            image[k, r, c] = color
+
+
+@ti.data_oriented
+class StaticLayer:
+    def __init__(self,
+                 maps,
+                 img_size=(540, 540),
+                 trails_color=0xa0a0a0,
+                 edge_samples=32,
+                 node_radius=3):
+        """ rgb image of the static map and its trails, rasterized once per env on the device
+
+            Args:
+                maps: Static_maps, the trails are drawn over the grid of field_map
+                img_size: (H, W) of the image
+                edge_samples: points sampled along each edge, bezier edges are drawn as this many segments
+        """
+        self.maps = maps
+        self.env_num = maps.env_num
+        self.img_size = tuple(img_size)
+        self.trails_color = trails_color
+        self.edge_samples = edge_samples
+        self.node_radius = node_radius
+        self.image = ti.Vector.field(3, dtype=ti.u8, shape=(self.env_num, *self.img_size), name="static layer")
+        self.valid = False
+        self.dirty = None # (i0, j0, i1, j1) map cells to redraw, None: the whole map
+        self.trails_version = None
+
+    def invalidate(self, region=None):
+        """ mark the layer for redraw, region = (i0, j0, i1, j1) limits it to the map cells [i0, i1) x [j0, j1)
+            that changed, the whole layer when None
+        """
+        if region is None or not self.valid:
+            self.valid = False
+            self.dirty = None
+            return
+        self.dirty = region if self.dirty is None else (min(self.dirty[0], region[0]), min(self.dirty[1], region[1]),
+                                                        max(self.dirty[2], region[2]), max(self.dirty[3], region[3]))
+
+    def update(self):
+        """ redraw the invalidated part of the layer, nothing when the map and the trails did not change """
+        trails = self.maps.trails
+        if trails.version != self.trails_version:
+            self.invalidate()
+        if self.valid and self.dirty is None:
+            return self.image
+
+        grid_n = self.maps.field_map.shape[0]
+        i0, j0, i1, j1 = (0, 0, grid_n, grid_n) if not self.valid else self.dirty
+        h, w = self.img_size
+        # pixels whose map cell lies in the region, then the trails on top (they are cheap to redraw)
+        c0, c1 = (i0 * w + grid_n - 1) // grid_n, (i1 * w + grid_n - 1) // grid_n
+        r0, r1 = h - (j1 * h + grid_n - 1) // grid_n, h - (j0 * h + grid_n - 1) // grid_n
+        self.draw_map(self.maps.field_map, max(r0, 0), min(r1, h), max(c0, 0), min(c1, w))
+        color = rgb(self.trails_color)
+        if trails.edges_num > 0:
+            self.draw_edges(trails.edges, 1.0 / trails.max_size, color)
+        if trails.nodes_num > 0:
+            self.draw_nodes(trails.nodes, 1.0 / trails.max_size, color)
+        self.valid = True
+        self.dirty = None
+        self.trails_version = trails.version
+        return self.image
+
+    @ti.kernel
+    def draw_map(self, field: ti.template(), r0: ti.i32, r1: ti.i32, c0: ti.i32, c1: ti.i32):
+        h, w = self.image.shape[1], self.image.shape[2]
+        for k, r, c in ti.ndrange(self.env_num, (r0, r1), (c0, c1)):
+            x = (c * field.shape[0]) // w
+            y = ((h - 1 - r) * field.shape[1]) // h
+            gray = ti.cast(field[x, y, k], ti.u8)
+            self.image[k, r, c] = ti.Vector([gray, gray, gray])
+
+    @ti.kernel
+    def to_canvas(self, layer: ti.template(), canvas: ti.template(), env_idx: ti.i32):
+        """ copy env env_idx of an image into a (W, H) ti.GUI canvas (x to the right, y up) """
+        h = layer.shape[1]
+        for x, y in canvas:
+            canvas[x, y] = layer[env_idx, h - 1 - y, x]
+
+    @ti.kernel
+    def blend_canvas(self, canvas: ti.template(), field: ti.template(), env_idx: ti.i32, scale: ti.f32,
+                     color: ti.types.vector(3, ti.u8)):
+        w, h = canvas.shape[0], canvas.shape[1]
+        for x, y in canvas:
+            alpha = tm.clamp(field[(x * field.shape[0]) // w, (y * field.shape[1]) // h, env_idx] * scale, 0.0, 1.0)
+            canvas[x, y] = ti.cast(ti.cast(canvas[x, y], ti.f32) * (1 - alpha) + ti.cast(color, ti.f32) * alpha, ti.u8)
+
+    @ti.kernel
+    def draw_edges(self, edges: ti.template(), scale: ti.f32, color: ti.types.vector(3, ti.u8)):
+        h, w = self.image.shape[1], self.image.shape[2]
+        for i, k, s in ti.ndrange(edges.shape[0], edges.shape[1], self.edge_samples):
+            p0 = edges[i, k].get_t_pos(s / self.edge_samples) * scale
+            p1 = edges[i, k].get_t_pos((s + 1) / self.edge_samples) * scale
+            # one pixel per step along the segment
+            steps = ti.cast(ti.max(ti.abs(p1[0] - p0[0]) * w, ti.abs(p1[1] - p0[1]) * h), ti.i32) + 1
+            for n in range(steps + 1):
+                p = p0 + (p1 - p0) * (n / steps)
+                r = ti.cast((1 - p[1]) * h, ti.i32)
+                c = ti.cast(p[0] * w, ti.i32)
+                if 0 <= r < h and 0 <= c < w:
+                    self.image[k, r, c] = color
+
+    @ti.kernel
+    def draw_nodes(self, nodes: ti.template(), scale: ti.f32, color: ti.types.vector(3, ti.u8)):
+        for i, k in nodes:
+            stamp_disc(self.image, k, nodes[i, k].pos * scale, self.node_radius, color)
+
+
+@ti.data_oriented
+class OffscreenRenderer:
+    def __init__(self,
+                 maps,
+                 img_size=(540, 540),
+                 agent_radius=2,
+                 free_agents_color=0x3060d0,
+                 trail_agents_color=0xd06030,
+                 npc_color=0x30a040,
+                 field_color=0xff0000,
+                 **layer_args):
+        """ headless renderer drawing the frames of all envs at once into a preallocated (envs, H, W) rgb field
+
+            Args:
+                maps: Static_maps, its map and trails form the cached background of every env
+                agent_radius: radius of the agent discs in pixels
+                layer_args: forwarded to StaticLayer (trails_color, edge_samples, node_radius)
+            Comments:
+                nothing is copied to the host while rendering, see FrameWriter to stream the frames to disk
+        """
+        self.maps = maps
+        self.env_num = maps.env_num
+        self.img_size = tuple(img_size)
+        self.agent_radius = agent_radius
+        self.colors = {"free_agents": free_agents_color, "trail_agents": trail_agents_color,
+                       "npc": npc_color, "field": field_color}
+        self.static_layer = StaticLayer(maps, self.img_size, **layer_args)
+        self.frames = ti.Vector.field(3, dtype=ti.u8, shape=(self.env_num, *self.img_size), name="frames")
+
+    def color(self, name):
+        return rgb(self.colors[name])
+
+    def render(self, swarm=None, npcs=None, npc_world_size=None, dynamic_maps=None, field_max=1.0):
+        """ draw one frame of every env: static layer, then the dynamic map, the npcs and the agents on top
+
+            Args:
+                swarm: SwarmAgents, free agents in [0, simulation_size]^2, trail agents in the trails coordinates
+                npcs: NPC field (npc_n, env_num), drawn in [0, npc_world_size]^2 (the maps size by default)
+                dynamic_maps: Dynamic_maps whose field_map is blended in field_color, saturated at field_max
+            Returns:
+                frames field (env_num, H, W) of rgb u8
+        """
+        self.copy_layer(self.static_layer.update())
+        if dynamic_maps is not None:
+            self.blend_field(dynamic_maps.field_map, 1.0 / field_max, self.color("field"))
+        if npcs is not None:
+            world_size = self.maps.max_size if npc_world_size is None else npc_world_size
+            self.draw_points(npcs.pos, npcs.shape[0], 1.0 / world_size, self.color("npc"))
+        if swarm is not None:
+            if swarm.trail_n > 0:
+                self.draw_points(swarm.trail_agents.pos, swarm.trail_n, 1.0 / self.maps.trails.max_size,
+                                 self.color("trail_agents"))
+            self.draw_points(swarm.free_agents.pos, swarm.free_n, 1.0 / swarm.simulation_size,
+                             self.color("free_agents"))
+        return self.frames
+
+    @ti.kernel
+    def copy_layer(self, layer: ti.template()):
+        for k, r, c in self.frames:
+            self.frames[k, r, c] = layer[k, r, c]
+
+    @ti.kernel
+    def blend_field(self, field: ti.template(), scale: ti.f32, color: ti.types.vector(3, ti.u8)):
+        h, w = self.frames.shape[1], self.frames.shape[2]
+        for k, r, c in self.frames:
+            x = (c * field.shape[0]) // w
+            y = ((h - 1 - r) * field.shape[1]) // h
+            alpha = tm.clamp(field[x, y, k] * scale, 0.0, 1.0)
+            pixel = ti.cast(self.frames[k, r, c], ti.f32) * (1 - alpha) + ti.cast(color, ti.f32) * alpha
+            self.frames[k, r, c] = ti.cast(pixel, ti.u8)
+
+    @ti.kernel
+    def draw_points(self, positions: ti.template(), count: ti.i32, scale: ti.f32, color: ti.types.vector(3, ti.u8)):
+        for i, k in ti.ndrange(count, self.env_num):
+            stamp_disc(self.frames, k, positions[i, k] * scale, self.agent_radius, color)
+
+
+@ti.data_oriented
+class FrameWriter:
+    def __init__(self,
+                 renderer,
+                 prefix,
+                 chunk_frames=16,
+                 frame_format="npz"):
+        """ stream the frames of a renderer to disk in chunks of chunk_frames frames
+
+            Args:
+                prefix: path prefix of the output, "npz": prefix_00000.npz, prefix_00001.npz ... each holding
+                        frames of shape (n, envs, H, W, 3), "raw": one prefix.raw file of uint8 frames
+                        and prefix.json with its shape
+            Comments:
+                frames are gathered in a device side chunk, the host only copies full chunks
+        """
+        if frame_format not in FRAME_FORMATS:
+            raise ValueError(f"unknown frame format: {frame_format}")
+        self.renderer = renderer
+        self.prefix = prefix
+        self.chunk_frames = chunk_frames
+        self.frame_format = frame_format
+        self.chunk = ti.Vector.field(3, dtype=ti.u8, shape=(self.chunk_frames, *renderer.frames.shape),
+                                     name="frames chunk")
+        self.chunk_fill = 0
+        self.chunks_written = 0
+        self.frames_written = 0
+        self.raw_file = open(f"{self.prefix}.raw", 'wb') if self.frame_format == "raw" else None
+
+    def write(self):
+        """ append the current frames of the renderer """
+        self.store_frame(self.renderer.frames, self.chunk_fill)
+        self.chunk_fill += 1
+        if self.chunk_fill == self.chunk_frames:
+            self.flush()
+
+    @ti.kernel
+    def store_frame(self, frames: ti.template(), slot: ti.i32):
+        for k, r, c in frames:
+            self.chunk[slot, k, r, c] = frames[k, r, c]
+
+    def flush(self):
+        """ write the frames gathered so far """
+        if self.chunk_fill == 0:
+            return
+        frames = self.chunk.to_numpy()[:self.chunk_fill]
+        if self.frame_format == "npz":
+            np.savez_compressed(f"{self.prefix}_{self.chunks_written:05d}.npz", frames=frames)
+        else:
+            self.raw_file.write(frames.tobytes())
+        self.frames_written += self.chunk_fill
+        self.chunks_written += 1
+        self.chunk_fill = 0
+
+    def close(self):
+        self.flush()
+        if self.raw_file is not None:
+            self.raw_file.close()
+            self.raw_file = None
+            with open(f"{self.prefix}.json", 'w') as json_file:
+                json.dump({"dtype": "uint8", "shape": [self.frames_written, *self.chunk.shape[1:], 3]}, json_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,267 @@
+import numpy as np
+import multiprocessing as mp
+import time
+import traceback
+from functools import partial
+from multiprocessing import shared_memory
+
+import os
+import sys
+
+# Get the parent directory of the current script
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+
+# Add the parent directory to the Python path
+sys.path.append(parent_directory)
+
+from scenario import build_scenario, is_scenario_file, read_scenario, slice_envs
+
+# control words of the ring buffer: steps consumed by the reader, stop request
+CONSUMED, STOP = 0, 1
+
+
+class SharedArrays:
+    def __init__(self, arrays=None, spec=None):
+        """ numpy arrays living in multiprocessing.shared_memory blocks
+
+            Args:
+                arrays: dict {name: array or (shape, dtype)}, creates the blocks (owner, unlinks them on close)
+                spec: picklable description returned by .spec of the owner, attaches to its blocks
+        """
+        self.owner = spec is None
+        self.blocks = {}
+        self.arrays = {}
+        if self.owner:
+            for name, array in arrays.items():
+                shape, dtype = (array if isinstance(array, tuple) else (array.shape, array.dtype))
+                nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+                block = shared_memory.SharedMemory(create=True, size=nbytes)
+                self.blocks[name] = block
+                self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+                if not isinstance(array, tuple):
+                    self.arrays[name][...] = array
+        else:
+            for name, (block_name, shape, dtype) in spec.items():
+                block = shared_memory.SharedMemory(name=block_name)
+                self.blocks[name] = block
+                self.arrays[name] = np.ndarray(tuple(shape), dtype=np.dtype(dtype), buffer=block.buf)
+
+    @property
+    def spec(self):
+        return {name: (self.blocks[name].name, array.shape, array.dtype.str) for name, array in self.arrays.items()}
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self):
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            if self.owner:
+                block.unlink()
+        self.blocks = {}
+
+
+def load_scenario(static_maps_settings_file=None, trails_settings_file=None, **sizes):
+    """ header and arrays of a compiled scenario file or of json / yaml settings files (see build_scenario) """
+    if static_maps_settings_file is not None and is_scenario_file(static_maps_settings_file):
+        return read_scenario(static_maps_settings_file)
+    return build_scenario(static_maps_settings_file, trails_settings_file, **sizes)
+
+
+def check_flocking_scenario(header):
+    """ raise ValueError unless the scenario holds both the grid and the trails Static_maps is built from """
+    missing = [part for part, key in (("static grid", "grid_n"), ("trails", "nodes_num")) if key not in header]
+    if missing:
+        raise ValueError(f"the scenario has no {' and no '.join(missing)}, flocking_env builds Static_maps "
+                         f"which needs both, pass an env_fn for this scenario")
+
+
+def flocking_env(num_envs, scenario, seed, free_n=32, **env_args):
+    """ default env of the rollout workers: a FlockingVecEnv sensing the Static_maps of the scenario shard """
+    from static_maps import Static_maps
+    from vec_env import FlockingVecEnv
+
+    maps = None
+    if scenario is not None:
+        header, _ = scenario
+        check_flocking_scenario(header)
+        maps = Static_maps(header["grid_n"], header["nodes_num"], header["edges_num"], num_envs,
+                           None, None, scenario=scenario)
+    return FlockingVecEnv(num_envs, free_n, maps=maps, seed=seed, **env_args)
+
+
+def random_policy(obs, rng):
+    """ uniform accelerations in [-1, 1]^2 for every agent """
+    return rng.uniform(-1.0, 1.0, size=obs.shape[:2] + (2,)).astype(np.float32)
+
+
+def _worker(worker_idx, env_start, env_stop, scenario_spec, header, ring_spec, commands, errors,
+            env_fn, policy_fn, seed, threads, poll_interval):
+    scenario_arrays = ring = None
+    try:
+        import taichi as ti
+        ti.init(arch=ti.cpu, cpu_max_num_threads=threads)
+
+        scenario = None
+        if scenario_spec is not None:
+            scenario_arrays = SharedArrays(spec=scenario_spec)
+            scenario = slice_envs(header, scenario_arrays.arrays, env_start, env_stop)
+        env = env_fn(env_stop - env_start, scenario, seed + worker_idx)
+        obs = env.reset()
+        rng = np.random.default_rng(seed + worker_idx)
+
+        ring = SharedArrays(spec=ring_spec)
+        ring_obs, ring_rewards, ring_dones = ring["obs"], ring["rewards"], ring["dones"]
+        progress, control = ring["progress"], ring["control"]
+        ring_length = ring_obs.shape[0]
+        while True:
+            steps = commands.get()
+            if steps is None:
+                break
+            for _ in range(steps):
+                # wait for the reader to free the slot
+                while progress[worker_idx] - control[CONSUMED] >= ring_length and not control[STOP]:
+                    time.sleep(poll_interval)
+                if control[STOP]:
+                    break
+                actions = policy_fn(obs, rng)
+                # the env writes its shard of the slot in place
+                slot = progress[worker_idx] % ring_length
+                env.obs = ring_obs[slot, env_start:env_stop]
+                env.rewards = ring_rewards[slot, env_start:env_stop]
+                env.dones = ring_dones[slot, env_start:env_stop]
+                obs, _, _ = env.step(actions)
+                progress[worker_idx] += 1
+    except Exception:
+        errors.put((worker_idx, traceback.format_exc()))
+    finally:
+        for shared in (scenario_arrays, ring):
+            if shared is not None:
+                shared.close()
+
+
+class RolloutRunner:
+    def __init__(self,
+                 num_envs,
+                 num_workers=None,
+                 scenario=None,
+                 env_fn=flocking_env,
+                 policy_fn=random_policy,
+                 obs_shape=None,
+                 ring_length=64,
+                 seed=0,
+                 threads_per_worker=1,
+                 poll_interval=1e-4,
+                 **env_args):
+        """ shard num_envs envs over a pool of worker processes, each with its own taichi cpu runtime
+
+            Args:
+                scenario: (header, arrays) of load_scenario, copied once into shared memory and attached
+                          by every worker, which keeps its env shard without parsing any file,
+                          the default env_fn needs both the static grid and the trails
+                env_fn: env_fn(num_envs, scenario shard or None, seed, **env_args) builds the env of a worker,
+                        it needs reset(), step(actions) and obs / rewards / dones arrays written in place
+                        (see FlockingVecEnv), must be picklable (module level function or partial)
+                policy_fn: policy_fn(obs, rng) -> actions, run in the workers
+                obs_shape: obs shape of one env, defaults to the one of FlockingVecEnv
+                ring_length: steps kept in the shared ring buffer, the workers wait when the reader lags
+                             ring_length steps behind
+            Comments:
+                the workers step independently, rollout yields a step once every shard has written it
+        """
+        self.num_envs = num_envs
+        self.num_workers = min(num_workers or os.cpu_count(), num_envs)
+        self.ring_length = ring_length
+        self.poll_interval = poll_interval
+        self.consumed = 0
+        if obs_shape is None:
+            from vec_env import OBS_DIM, MAP_OBS_DIM
+            obs_shape = (env_args.get("free_n", 32), OBS_DIM + (MAP_OBS_DIM if scenario is not None else 0))
+
+        self.scenario_arrays = None
+        header = None
+        if scenario is not None:
+            header, arrays = scenario
+            if header.get("env_num", 0) < num_envs:
+                raise ValueError(f"scenario holds {header.get('env_num', 0)} envs, {num_envs} required")
+            if env_fn is flocking_env:
+                check_flocking_scenario(header)
+            self.scenario_arrays = SharedArrays(arrays)
+        self.ring = SharedArrays({"obs": ((ring_length, num_envs) + tuple(obs_shape), np.float32),
+                                  "rewards": ((ring_length, num_envs), np.float32),
+                                  "dones": ((ring_length, num_envs), np.uint8),
+                                  "progress": ((self.num_workers,), np.int64),
+                                  "control": ((2,), np.int64)})
+        self.ring["progress"][...] = 0
+        self.ring["control"][...] = 0
+
+        # spawn: the workers must not inherit a taichi runtime
+        context = mp.get_context("spawn")
+        self.errors = context.Queue()
+        self.commands = []
+        self.workers = []
+        bounds = np.linspace(0, num_envs, self.num_workers + 1).astype(int)
+        for w in range(self.num_workers):
+            commands = context.Queue()
+            worker = context.Process(target=_worker, daemon=True,
+                                     args=(w, bounds[w], bounds[w + 1],
+                                           None if self.scenario_arrays is None else self.scenario_arrays.spec,
+                                           header, self.ring.spec, commands, self.errors,
+                                           partial(env_fn, **env_args), policy_fn, seed, threads_per_worker,
+                                           poll_interval))
+            worker.start()
+            self.commands.append(commands)
+            self.workers.append(worker)
+
+    def check_workers(self):
+        if not self.errors.empty():
+            worker_idx, error = self.errors.get()
+            self.close()
+            raise RuntimeError(f"rollout worker {worker_idx} failed:\n{error}")
+        if any(not worker.is_alive() for worker in self.workers):
+            self.close()
+            raise RuntimeError("a rollout worker exited")
+
+    def rollout(self, steps):
+        """ run every env for steps steps
+
+            Yields:
+                step index, obs (num_envs, ...), rewards (num_envs,), dones (num_envs,) of that step,
+                views of the ring buffer that are valid until the next iteration
+        """
+        for commands in self.commands:
+            commands.put(steps)
+        progress, control = self.ring["progress"], self.ring["control"]
+        for _ in range(steps):
+            while progress.min() <= self.consumed:
+                self.check_workers()
+                time.sleep(self.poll_interval)
+            slot = self.consumed % self.ring_length
+            yield self.consumed, self.ring["obs"][slot], self.ring["rewards"][slot], self.ring["dones"][slot]
+            self.consumed += 1
+            control[CONSUMED] = self.consumed
+
+    def close(self):
+        if self.ring is None:
+            return
+        self.ring["control"][STOP] = 1
+        for commands, worker in zip(self.commands, self.workers):
+            if worker.is_alive():
+                commands.put(None)
+        for worker in self.workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self.ring.close()
+        self.ring = None
+        if self.scenario_arrays is not None:
+            self.scenario_arrays.close()
+            self.scenario_arrays = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,187 @@
+import numpy as np
+import yaml
+import json
+
+# compiled scenario layout (little endian):
+#   magic (8 bytes) | header length (uint64) | json header | arrays, each aligned to ALIGNMENT bytes
+# the header keeps the scenario sizes (grid_n, max_size, trails_max_size, nodes_num, edges_num, env_num)
+# and the dtype / shape / offset of every array, so each array can be mapped with np.memmap directly
+SCENARIO_MAGIC = b"FLKSCN01"
+SCENARIO_SUFFIX = ".scn"
+ALIGNMENT = 64
+
+# CFullLoader / CDumper are only available when PyYAML is built with libyaml
+YAML_LOADER = getattr(yaml, "CFullLoader", yaml.FullLoader)
+YAML_DUMPER = getattr(yaml, "CDumper", yaml.Dumper)
+
+TRAILS_ARRAYS = ("node_pos_vector", "nodes_attribute",
+                 "edges_ind_s", "edges_ind_e",
+                 "edges_pos_s", "edges_pos_e",
+                 "edges_con_s", "edges_con_e",
+                 "edges_line_state")
+
+
+def is_scenario_file(file_name):
+    return str(file_name).endswith(SCENARIO_SUFFIX)
+
+
+def load_settings(file_name):
+    """ load a json or yaml settings file into a dict """
+    if file_name[-4:] == "json":
+        with open(file_name, 'r') as json_file:
+            data = json.load(json_file)
+    elif file_name[-4:] == "yaml":
+        with open(file_name, 'r') as yaml_file:
+            data = yaml.load(yaml_file, Loader=YAML_LOADER)
+    else:
+        raise ValueError(f"unknown settings file type: {file_name}")
+    if data is None:
+        raise ValueError(f"empty settings file: {file_name}")
+    return data
+
+
+def unpack_trails_data(dict_input, nodes_num, edges_num, env_num):
+    """ parse the trails dict (same layout as Trails.warp_data) into contiguous numpy arrays in one pass
+
+        Returns:
+            dict of numpy arrays named after the arguments of Trails.generate_trails,
+            shaped (nodes_num or edges_num, env_num[, 2])
+    """
+    envs = dict_input["envs"][:env_num]
+    if len(envs) < env_num:
+        raise ValueError(f"trails data has {len(envs)} envs, {env_num} required")
+
+    nodes = [env["nodes"][:nodes_num] for env in envs]
+    edges = [env["edges"][:edges_num] for env in envs]
+    if any(len(env_nodes) < nodes_num for env_nodes in nodes) or \
+       any(len(env_edges) < edges_num for env_edges in edges):
+        raise ValueError(f"trails data has fewer than {nodes_num} nodes or {edges_num} edges in an env")
+
+    def nodes_column(key, dtype):
+        return np.array([[node[key] for node in env_nodes] for env_nodes in nodes], dtype=dtype)
+
+    def edges_column(key, dtype):
+        return np.array([[edge[key] for edge in env_edges] for env_edges in edges], dtype=dtype)
+
+    # columns are parsed as (env, element, ...) and stored element-major as used by the fields
+    columns = {
+        "node_pos_vector": nodes_column("pos", np.float32),
+        "nodes_attribute": nodes_column("attribute", np.int8),
+        "edges_ind_s": edges_column("s_node_idx", np.int32),
+        "edges_ind_e": edges_column("e_node_idx", np.int32),
+        "edges_pos_s": edges_column("s_pos", np.float32),
+        "edges_pos_e": edges_column("e_pos", np.float32),
+        "edges_con_s": edges_column("s_con", np.float32),
+        "edges_con_e": edges_column("e_con", np.float32),
+        "edges_line_state": edges_column("line_state", np.float32),
+    }
+    return {name: np.ascontiguousarray(np.swapaxes(column, 0, 1)) for name, column in columns.items()}
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_scenario(file_name, header, arrays):
+    """ write the header dict and the named numpy arrays into one compiled scenario file """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _align(offset + array.nbytes)
+
+    header_bytes = json.dumps(dict(header, arrays=layout)).encode()
+    data_start = _align(len(SCENARIO_MAGIC) + 8 + len(header_bytes))
+    with open(file_name, 'wb') as scenario_file:
+        scenario_file.write(SCENARIO_MAGIC)
+        scenario_file.write(np.uint64(len(header_bytes)).tobytes())
+        scenario_file.write(header_bytes)
+        for name, array in arrays.items():
+            scenario_file.seek(data_start + layout[name]["offset"])
+            scenario_file.write(array.tobytes())
+
+
+def read_scenario(file_name):
+    """ map a compiled scenario file without copying it
+
+        Returns:
+            header: dict of the scenario sizes
+            arrays: dict of read-only np.memmap arrays
+    """
+    with open(file_name, 'rb') as scenario_file:
+        if scenario_file.read(len(SCENARIO_MAGIC)) != SCENARIO_MAGIC:
+            raise ValueError(f"not a compiled scenario file: {file_name}")
+        header_len = int(np.frombuffer(scenario_file.read(8), dtype=np.uint64)[0])
+        header = json.loads(scenario_file.read(header_len).decode())
+    data_start = _align(len(SCENARIO_MAGIC) + 8 + header_len)
+
+    arrays = {}
+    for name, layout in header.pop("arrays").items():
+        arrays[name] = np.memmap(file_name, dtype=np.dtype(layout["dtype"]), mode='r',
+                                 offset=data_start + layout["offset"], shape=tuple(layout["shape"]))
+    return header, arrays
+
+
+def build_scenario(static_maps_settings_file=None, trails_settings_file=None,
+                   nodes_num=None, edges_num=None, env_num=None):
+    """ parse the json / yaml settings of the static grid and / or the trails graph
+
+        Args:
+            static_maps_settings_file: json / yaml file of Static_maps (grid_n, max_size, maps)
+            trails_settings_file: json / yaml file of Trails (max_size, envs)
+            nodes_num, edges_num, env_num: sizes to keep, taken from the files when None
+        Returns:
+            header, arrays as returned by read_scenario
+    """
+    header = {}
+    arrays = {}
+    if static_maps_settings_file is not None:
+        data = load_settings(static_maps_settings_file)
+        field_map = np.asarray(data["maps"], dtype=np.uint8)
+        if env_num is not None:
+            field_map = field_map[:, :, :env_num]
+        header.update(grid_n=data["grid_n"], max_size=data["max_size"], env_num=field_map.shape[2])
+        arrays["field_map"] = field_map
+
+    if trails_settings_file is not None:
+        data = load_settings(trails_settings_file)
+        env_num = env_num or header.get("env_num") or len(data["envs"])
+        nodes_num = nodes_num or len(data["envs"][0]["nodes"])
+        edges_num = edges_num or len(data["envs"][0]["edges"])
+        header.update(trails_max_size=data["max_size"], nodes_num=nodes_num, edges_num=edges_num, env_num=env_num)
+        arrays.update(unpack_trails_data(data, nodes_num, edges_num, env_num))
+    return header, arrays
+
+
+def compile_scenario(output_file, static_maps_settings_file=None, trails_settings_file=None,
+                     nodes_num=None, edges_num=None, env_num=None):
+    """ compile the json / yaml settings of build_scenario into one binary file
+
+        Args:
+            output_file: path of the compiled scenario, should end with SCENARIO_SUFFIX
+    """
+    write_scenario(output_file, *build_scenario(static_maps_settings_file, trails_settings_file,
+                                                nodes_num, edges_num, env_num))
+
+
+def slice_envs(header, arrays, env_start, env_stop):
+    """ views of the envs [env_start, env_stop) of a scenario, the env axis is the last grid axis
+        of field_map and the axis after the element axis of the trails arrays
+    """
+    arrays = {name: array[:, :, env_start:env_stop] if name == "field_map" else array[:, env_start:env_stop]
+              for name, array in arrays.items()}
+    return dict(header, env_num=env_stop - env_start), arrays
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="compile json / yaml scenario settings into a binary scenario file")
+    parser.add_argument("output_file")
+    parser.add_argument("--maps", dest="static_maps_settings_file", default=None)
+    parser.add_argument("--trails", dest="trails_settings_file", default=None)
+    parser.add_argument("--env-num", dest="env_num", type=int, default=None)
+    args = parser.parse_args()
+    compile_scenario(args.output_file, args.static_maps_settings_file, args.trails_settings_file,
+                     env_num=args.env_num)
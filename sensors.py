@@ -0,0 +1,202 @@
+import taichi as ti
+import taichi.math as tm
+
+import os
+import sys
+
+# Get the parent directory of the current script
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+
+# Add the parent directory to the Python path
+sys.path.append(parent_directory)
+
+from utils.utils import vec2
+from field_layout import place_field
+
+# cell (i, j) of a map covers [i, i + 1) * grid_length x [j, j + 1) * grid_length, its value sits at the cell center,
+# queries outside the map are clamped to the border cells
+
+
+@ti.func
+def sample_nearest(field: ti.template(), pos, k, grid_length):
+    """ value of the cell containing pos and its central difference gradient, in env k of a (n, n, env) field """
+    n = field.shape[0]
+    i = tm.clamp(ti.cast(ti.floor(pos[0] / grid_length), ti.i32), 0, n - 1)
+    j = tm.clamp(ti.cast(ti.floor(pos[1] / grid_length), ti.i32), 0, n - 1)
+    i0, i1 = ti.max(i - 1, 0), ti.min(i + 1, n - 1)
+    j0, j1 = ti.max(j - 1, 0), ti.min(j + 1, n - 1)
+    value = ti.cast(field[i, j, k], ti.f32)
+    grad = vec2((ti.cast(field[i1, j, k], ti.f32) - ti.cast(field[i0, j, k], ti.f32)) / (ti.max(i1 - i0, 1) * grid_length),
+                (ti.cast(field[i, j1, k], ti.f32) - ti.cast(field[i, j0, k], ti.f32)) / (ti.max(j1 - j0, 1) * grid_length))
+    return value, grad
+
+
+@ti.func
+def sample_bilinear(field: ti.template(), pos, k, grid_length):
+    """ bilinear interpolation of the cell centers around pos and the gradient of the interpolant """
+    n = field.shape[0]
+    p = tm.clamp(pos / grid_length - 0.5, 0.0, n - 1.0)
+    i = tm.clamp(ti.cast(ti.floor(p[0]), ti.i32), 0, ti.max(n - 2, 0))
+    j = tm.clamp(ti.cast(ti.floor(p[1]), ti.i32), 0, ti.max(n - 2, 0))
+    i1, j1 = ti.min(i + 1, n - 1), ti.min(j + 1, n - 1)
+    fx, fy = p[0] - i, p[1] - j
+    v00 = ti.cast(field[i, j, k], ti.f32)
+    v10 = ti.cast(field[i1, j, k], ti.f32)
+    v01 = ti.cast(field[i, j1, k], ti.f32)
+    v11 = ti.cast(field[i1, j1, k], ti.f32)
+    value = (v00 * (1 - fx) + v10 * fx) * (1 - fy) + (v01 * (1 - fx) + v11 * fx) * fy
+    grad = vec2((v10 - v00) * (1 - fy) + (v11 - v01) * fy,
+                (v01 - v00) * (1 - fx) + (v11 - v10) * fx) / grid_length
+    return value, grad
+
+
+@ti.data_oriented
+class MipPyramid:
+    def __init__(self,
+                 grid_n,
+                 env_num,
+                 levels,
+                 env_major=False):
+        """ 2x downsampled averages of a (grid_n, grid_n, env_num) map, level 0 is the map itself
+
+            Args:
+                levels: number of coarse levels kept, capped where a level is a single cell
+            Comments:
+                the map is passed to update / sample_area instead of being kept, so double buffered
+                maps can swap their field_map
+        """
+        self.grid_n = grid_n
+        self.env_num = env_num
+        sizes = []
+        size = grid_n
+        while len(sizes) < levels and size > 1:
+            size = (size + 1) // 2
+            sizes.append(size)
+        self.levels = [place_field(ti.f32, (size, size, self.env_num), env_major, name=f"mip level {l + 1}")
+                       for l, size in enumerate(sizes)]
+        self.levels_num = len(self.levels)
+
+    def update(self, field, region=None):
+        """ rebuild the coarse levels over region = (i0, j0, i1, j1), the cells [i0, i1) x [j0, j1) of the map
+            that changed, the whole map when None
+        """
+        if self.levels_num == 0:
+            return
+        i0, j0, i1, j1 = (0, 0, self.grid_n, self.grid_n) if region is None else region
+        self.reduce_levels(field, max(i0, 0), max(j0, 0), min(i1, self.grid_n), min(j1, self.grid_n))
+
+    def level_field(self, field, l):
+        """ field of level l, evaluated at compile time """
+        return field if l == 0 else self.levels[l - 1]
+
+    @ti.kernel
+    def reduce_levels(self, field: ti.template(), i0: ti.i32, j0: ti.i32, i1: ti.i32, j1: ti.i32):
+        # one top level loop per level, run in order inside the launch
+        for l in ti.static(range(1, self.levels_num + 1)):
+            src = ti.static(self.level_field(field, l - 1))
+            dst = ti.static(self.levels[l - 1])
+            for i, j, k in ti.ndrange((i0 >> l, ((i1 - 1) >> l) + 1), (j0 >> l, ((j1 - 1) >> l) + 1), self.env_num):
+                total = 0.0
+                count = 0
+                for di, dj in ti.static(ti.ndrange(2, 2)):
+                    if 2 * i + di < src.shape[0] and 2 * j + dj < src.shape[1]:
+                        total += ti.cast(src[2 * i + di, 2 * j + dj, k], ti.f32)
+                        count += 1
+                dst[i, j, k] = total / count
+
+    @ti.func
+    def sample_area(self, field: ti.template(), pos, radius, k, grid_length):
+        """ mean of the map over a disc of radius around pos, read from the level whose cells span the disc,
+            blended linearly between the two closest levels
+        """
+        level = tm.clamp(tm.log2(ti.max(2 * radius / grid_length, 1.0)), 0.0, ti.cast(self.levels_num, ti.f32))
+        l0 = ti.cast(ti.floor(level), ti.i32)
+        blend = level - l0
+        low, high = 0.0, 0.0
+        for l in ti.static(range(self.levels_num + 1)):
+            if l == l0 or l == l0 + 1:
+                value, _ = sample_bilinear(ti.static(self.level_field(field, l)), pos, k, grid_length * 2 ** l)
+                if l == l0:
+                    low = value
+                else:
+                    high = value
+        if blend == 0.0:
+            high = low
+        return low * (1 - blend) + high * blend
+
+
+@ti.data_oriented
+class MapSensor:
+    def __init__(self,
+                 agents_n,
+                 env_num,
+                 gradient=False,
+                 env_major=False):
+        """ preallocated observation of a map at agent positions, filled by one kernel launch per sample
+
+            Args:
+                agents_n, env_num: shape of the position fields that are sampled
+                gradient: also keep the spatial gradient of the sampled map
+                env_major: memory layout of the observation fields, see field_layout
+        """
+        self.agents_n = agents_n
+        self.env_num = env_num
+        self.gradient = gradient
+        self.values = place_field(ti.f32, (self.agents_n, self.env_num), env_major, name="sensed map values")
+        self.gradients = None
+        if self.gradient:
+            self.gradients = ti.Vector.field(2, dtype=ti.f32, shape=(self.agents_n, self.env_num),
+                                             name="sensed map gradients")
+
+    def sample(self, maps, positions, bilinear=True):
+        """ read maps.field_map at every position, agent i of env k reads env k of the map
+
+            Args:
+                maps: Static_maps / Dynamic_maps (any object with field_map and grid_length)
+                positions: vec2 field of shape (agents_n, env_num), e.g. SwarmAgents.free_agents.pos
+                bilinear: bilinear interpolation of the cell centers, nearest cell otherwise
+            Returns:
+                values field (agents_n, env_num), and gradients field when the sensor keeps them
+        """
+        if positions.shape != (self.agents_n, self.env_num):
+            raise ValueError(f"positions of shape {positions.shape} do not fit the sensor "
+                             f"of shape {(self.agents_n, self.env_num)}")
+        if maps.field_map.shape[2] != self.env_num:
+            raise ValueError(f"map has {maps.field_map.shape[2]} envs, the sensor {self.env_num}")
+        self.gather(maps.field_map, maps.grid_length, positions, bilinear)
+        if self.gradient:
+            return self.values, self.gradients
+        return self.values
+
+    def sample_area(self, maps, positions, radius):
+        """ mean of maps.field_map over a disc of radius around every position, from the mip pyramid of maps
+
+            Returns:
+                values field (agents_n, env_num)
+        """
+        if maps.pyramid is None:
+            raise ValueError("sample_area needs a map built with mip_levels > 0")
+        if positions.shape != (self.agents_n, self.env_num):
+            raise ValueError(f"positions of shape {positions.shape} do not fit the sensor "
+                             f"of shape {(self.agents_n, self.env_num)}")
+        self.gather_area(maps.pyramid, maps.field_map, maps.grid_length, positions, radius)
+        return self.values
+
+    @ti.kernel
+    def gather_area(self, pyramid: ti.template(), field: ti.template(), grid_length: ti.f32,
+                    positions: ti.template(), radius: ti.f32):
+        for i, k in positions:
+            self.values[i, k] = pyramid.sample_area(field, positions[i, k], radius, k, grid_length)
+
+    @ti.kernel
+    def gather(self, field: ti.template(), grid_length: ti.f32, positions: ti.template(), bilinear: ti.template()):
+        for i, k in positions:
+            value, grad = 0.0, vec2(0.0)
+            if ti.static(bilinear):
+                value, grad = sample_bilinear(field, positions[i, k], k, grid_length)
+            else:
+                value, grad = sample_nearest(field, positions[i, k], k, grid_length)
+            self.values[i, k] = value
+            if ti.static(self.gradient):
+                self.gradients[i, k] = grad
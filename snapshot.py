@@ -0,0 +1,204 @@
+import taichi as ti
+import numpy as np
+import json
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import os
+import sys
+
+# Get the parent directory of the current script
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+
+# Add the parent directory to the Python path
+sys.path.append(parent_directory)
+
+from scenario import read_scenario, write_scenario
+
+# a state is {"arrays": {path: numpy array}, "attrs": {path: python scalar}}, paths are the attribute names of
+# the holders joined by "/", "." separates list items and struct members (e.g. "swarm/free_agents_buffers.0.pos")
+# snapshot files use the compiled scenario layout (raw, memory mapped on load) or a compressed npz archive
+SNAPSHOT_ATTRS = "__attrs__"
+SCALAR_TYPES = (bool, int, float, np.bool_, np.integer, np.floating)
+
+
+def _is_holder(value):
+    return getattr(type(value), "_data_oriented", False)
+
+
+def _members(holder):
+    exclude = getattr(holder, "snapshot_exclude", ())
+    return [(name, value) for name, value in vars(holder).items() if name not in exclude]
+
+
+def capture_state(holder, prefix="", state=None, visited=None):
+    """ copy every taichi field and scalar attribute of holder (a data_oriented object, a field or a dict of
+        them) and of the holders it owns to numpy
+
+        Returns:
+            state dict, the arrays are private copies (later steps do not change them)
+    """
+    if state is None:
+        state = {"arrays": {}, "attrs": {}}
+    visited = set() if visited is None else visited
+    if isinstance(holder, dict):
+        for name, value in holder.items():
+            capture_state(value, f"{prefix}{name}/", state, visited)
+        return state
+    if isinstance(holder, ti.Field):
+        _capture_value(prefix.rstrip("/"), holder, state, visited)
+        return state
+    if id(holder) in visited:
+        return state
+    visited.add(id(holder))
+    for name, value in _members(holder):
+        _capture_value(prefix + name, value, state, visited)
+    return state
+
+
+def _capture_value(path, value, state, visited):
+    if isinstance(value, ti.Field):
+        data = value.to_numpy()
+        if isinstance(data, dict): # struct field, one array per member
+            for member, array in data.items():
+                state["arrays"][f"{path}.{member}"] = array
+        else:
+            state["arrays"][path] = data
+    elif isinstance(value, (list, tuple)):
+        for i, item in enumerate(value):
+            if isinstance(item, ti.Field) or _is_holder(item):
+                _capture_value(f"{path}.{i}", item, state, visited)
+    elif _is_holder(value):
+        capture_state(value, path + "/", state, visited)
+    elif isinstance(value, SCALAR_TYPES):
+        state["attrs"][path] = value.item() if isinstance(value, np.generic) else value
+
+
+def restore_state(holder, state, prefix="", visited=None):
+    """ write a state of capture_state / load_snapshot back into holder, which must have the same sizes
+
+        Comments:
+            fields that are not allocated in holder (lazily built tables) are skipped, holders may define
+            restored() to fix their state up afterwards
+    """
+    visited = set() if visited is None else visited
+    if isinstance(holder, dict):
+        for name, value in holder.items():
+            restore_state(value, state, f"{prefix}{name}/", visited)
+        return
+    if isinstance(holder, ti.Field):
+        _restore_value(holder, prefix.rstrip("/"), holder, None, state, visited)
+        return
+    if id(holder) in visited:
+        return
+    visited.add(id(holder))
+    for name, value in _members(holder):
+        _restore_value(holder, prefix + name, value, name, state, visited)
+    if hasattr(holder, "restored"):
+        holder.restored()
+
+
+def _restore_value(holder, path, value, name, state, visited):
+    arrays = state["arrays"]
+    if isinstance(value, ti.Field):
+        if path in arrays:
+            data = arrays[path]
+        else:
+            data = {member: arrays[f"{path}.{member}"] for member in value.keys
+                    if f"{path}.{member}" in arrays} if hasattr(value, "keys") else None
+            if not data:
+                return
+        shapes = [array.shape[:len(value.shape)] for array in (data.values() if isinstance(data, dict) else [data])]
+        if any(shape != value.shape for shape in shapes):
+            raise ValueError(f"snapshot {path} of shape {shapes[0]} does not fit the field of shape {value.shape}")
+        if isinstance(data, dict):
+            data = {member: np.ascontiguousarray(array) for member, array in data.items()}
+        else:
+            data = np.ascontiguousarray(data)
+        value.from_numpy(data)
+    elif isinstance(value, (list, tuple)):
+        for i, item in enumerate(value):
+            if isinstance(item, ti.Field) or _is_holder(item):
+                _restore_value(holder, f"{path}.{i}", item, None, state, visited)
+    elif _is_holder(value):
+        restore_state(value, state, path + "/", visited)
+    elif name is not None and isinstance(value, SCALAR_TYPES) and path in state["attrs"]:
+        setattr(holder, name, type(value)(state["attrs"][path]))
+
+
+def write_state(file_name, state, compress=False):
+    """ write a state into one file, raw aligned arrays or a compressed npz archive """
+    if compress:
+        with open(file_name, 'wb') as snapshot_file:
+            np.savez_compressed(snapshot_file, **state["arrays"],
+                                **{SNAPSHOT_ATTRS: np.frombuffer(json.dumps(state["attrs"]).encode(), dtype=np.uint8)})
+    else:
+        write_scenario(file_name, {SNAPSHOT_ATTRS: state["attrs"]}, state["arrays"])
+
+
+def read_state(file_name):
+    """ read a state written by write_state, raw arrays are memory mapped """
+    if zipfile.is_zipfile(file_name):
+        with np.load(file_name) as archive:
+            arrays = {name: archive[name] for name in archive.files}
+        attrs = json.loads(arrays.pop(SNAPSHOT_ATTRS).tobytes().decode())
+        return {"arrays": arrays, "attrs": attrs}
+    header, arrays = read_scenario(file_name)
+    return {"arrays": arrays, "attrs": header[SNAPSHOT_ATTRS]}
+
+
+class SnapshotWriter:
+    def __init__(self, max_pending=2):
+        """ write snapshots in a background thread, the fields are copied to the host before returning
+
+            Args:
+                max_pending: snapshots queued for writing, snapshot waits for the oldest beyond that
+        """
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.max_pending = max_pending
+        self.pending = []
+
+    def snapshot(self, holders, file_name, compress=False):
+        """ capture holders now and write them to file_name in the background
+
+            Returns:
+                future of the write
+        """
+        state = capture_state(holders)
+        self.pending = [future for future in self.pending if not future.done()]
+        while len(self.pending) >= self.max_pending:
+            self.pending.pop(0).result()
+        future = self.executor.submit(write_state, file_name, state, compress)
+        self.pending.append(future)
+        return future
+
+    def wait(self):
+        """ wait for every queued write, raise the first error """
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def save_snapshot(holders, file_name, compress=False, writer=None):
+    """ snapshot holders (data_oriented objects, fields or a dict of them) into file_name,
+        in the background when a SnapshotWriter is given (returns its future)
+    """
+    if writer is not None:
+        return writer.snapshot(holders, file_name, compress)
+    write_state(file_name, capture_state(holders), compress)
+
+
+def load_snapshot(holders, file_name):
+    """ restore holders from a snapshot file written for the same holders """
+    restore_state(holders, read_state(file_name))
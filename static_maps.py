@@ -4,6 +4,7 @@ import taichi.math as tm
 import numpy as np
 import yaml
 import json
+import textwrap
 
 import os
 import sys
@@ -15,86 +16,199 @@ parent_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
 # Add the parent directory to the Python path
 sys.path.append(parent_directory)
 
-from utils.utils import vec2, interpolation
-
-
-@ti.dataclass
-class Node:
-    idx: ti.i8       # node index (should be the same with index in Trails.nodes)
-    pos: vec2        # node position
-    attribute: ti.i8 # node attribute
-    # linked_edge_index: ti.Vector(10, ti.i32) # indexes of linked edges to node
-
-
-@ti.dataclass
-class Edge:
-    s_node_idx: ti.i8   # start node index
-    e_node_idx: ti.i8   # end node index
-    s_pos: vec2         # start node position
-    e_pos: vec2         # end node position
-    s_con: vec2         # start control point position (related to s_pos)
-    e_con: vec2         # end control point position (related to e_pos)
-    line_state: ti.f32  # 0: beizer line; 1: direct line.
-    line_length: ti.f32 # length of edge line
-
-    @ti.func
-    def get_t_pos(self, t):
-        bezier_pos = (1 - t)**3 * self.s_pos + 3 * (1 - t)**2 * t * self.s_con + 3 * (1 - t) * t**2 * self.e_con + t**3 * self.e_pos
-        line_pos = (self.e_pos - self.s_pos) * t + self.s_pos
-        return bezier_pos * self.line_state + line_pos * (1 - self.line_state)
-
-    @ti.func
-    def get_line_length(self, point_count=10):
-        direct_line_length = tm.length(self.e_pos - self.s_pos)
-        bezier_length = self.get_bezier_length(point_count)
-        return direct_line_length * self.line_state + bezier_length * (1 - self.line_state)
-
-    @ti.func
-    def get_bezier_length(self, point_count=10):
-        length = 0.0
-        last_point = self.get_t_pos(0.0)
-        for i in range(1, point_count+1):
-            t = (i*1.0) / point_count
-            point = self.get_t_pos(t)
-            length += tm.length(point - last_point)
-            last_point = point
-        return length
+from utils.utils import vec2
+from field_layout import LAYOUTS, place_field
+from scenario import TRAILS_ARRAYS, YAML_DUMPER, is_scenario_file, load_settings, read_scenario, unpack_trails_data
+from sensors import MipPyramid
+from renderer import StaticLayer, rgb
+from snapshot import capture_state, restore_state
+
+
+INDEX_TYPE_LIMITS = ((ti.i8, 2**7 - 1), (ti.i16, 2**15 - 1), (ti.i32, 2**31 - 1))
+
+
+def index_dtype(count):
+    """ smallest signed integer type holding the indices [-1, count] of count nodes / edges """
+    for dtype, limit in INDEX_TYPE_LIMITS:
+        if count <= limit:
+            return dtype
+    raise ValueError(f"{count} nodes / edges do not fit into a 32 bit index")
+
+
+_trail_structs = {}
+
+
+def trail_structs(index_type):
+    """ Node and Edge structs whose node / edge indices are stored as index_type (one pair per type) """
+    if index_type not in _trail_structs:
+        @ti.dataclass
+        class Node:
+            idx: index_type  # node index (should be the same with index in Trails.nodes)
+            pos: vec2         # node position
+            attribute: ti.i8  # node attribute
+            # linked_edge_index: ti.Vector(10, ti.i32) # indexes of linked edges to node
+
+        @ti.dataclass
+        class Edge:
+            s_node_idx: index_type # start node index
+            e_node_idx: index_type # end node index
+            s_pos: vec2            # start node position
+            e_pos: vec2            # end node position
+            s_con: vec2            # start control point position (related to s_pos)
+            e_con: vec2            # end control point position (related to e_pos)
+            line_state: ti.f32     # 0: beizer line; 1: direct line.
+            line_length: ti.f32    # length of edge line
+
+            @ti.func
+            def get_t_pos(self, t):
+                pos = (self.e_pos - self.s_pos) * t + self.s_pos
+                if self.line_state < 1.0:
+                    bezier_pos = (1 - t)**3 * self.s_pos + 3 * (1 - t)**2 * t * self.s_con + 3 * (1 - t) * t**2 * self.e_con + t**3 * self.e_pos
+                    pos = bezier_pos * (1 - self.line_state) + pos * self.line_state
+                return pos
+
+            @ti.func
+            def get_t_tangent(self, t):
+                """ derivative of get_t_pos with respect to t """
+                tangent = self.e_pos - self.s_pos
+                if self.line_state < 1.0:
+                    bezier_tangent = 3 * (1 - t)**2 * (self.s_con - self.s_pos) + 6 * (1 - t) * t * (self.e_con - self.s_con) + 3 * t**2 * (self.e_pos - self.e_con)
+                    tangent = bezier_tangent * (1 - self.line_state) + tangent * self.line_state
+                return tangent
+
+            @ti.func
+            def get_line_length(self, point_count=10):
+                length = tm.length(self.e_pos - self.s_pos)
+                if self.line_state < 1.0:
+                    length = self.get_bezier_length(point_count)
+                return length
+
+            @ti.func
+            def get_bezier_length(self, point_count=10):
+                length = 0.0
+                last_point = self.get_t_pos(0.0)
+                for i in range(1, point_count+1):
+                    t = (i*1.0) / point_count
+                    point = self.get_t_pos(t)
+                    length += tm.length(point - last_point)
+                    last_point = point
+                return length
+
+        _trail_structs[index_type] = (Node, Edge)
+    return _trail_structs[index_type]
+
+
+# widest structs, Trails generates the ones matching its own index width
+Node, Edge = trail_structs(ti.i32)
+
+
+def crop_array(array, size, env_num, leading_axes=1):
+    """ keep the first size elements on the leading axes and the first env_num envs of a scenario array,
+        arrays that already fit are returned as they are (no copy for memory mapped arrays)
+    """
+    index = (slice(0, size),) * leading_axes + (slice(0, env_num),)
+    if array.shape[:leading_axes + 1] == tuple(s.stop for s in index):
+        return array
+    return np.ascontiguousarray(array[index])
 
 
 @ti.data_oriented
 class Trails:
-    def __init__(self, nodes_num, edges_num, env_num, max_size=1, max_edges_2_node=10):
+    def __init__(self, nodes_num, edges_num, env_num, max_size=1, adjacency="dense", arc_samples=16):
+        """ 
+            Args:
+                arc_samples: number of segments of the arc length -> t table of every edge
+                adjacency: "dense" keeps the (nodes_num, nodes_num, env_num) a_matrix for O(1) is_connected,
+                           "sparse" drops it and answers is_connected by binary search on the CSR adjacency,
+                           so the memory scales with edges_num instead of nodes_num ** 2
+        """
+        if adjacency not in ("dense", "sparse"):
+            raise ValueError(f"unknown adjacency backend: {adjacency}")
         self.nodes_num = nodes_num
         self.edges_num = edges_num
         self.env_num = env_num
-        self.max_edges_2_node = max_edges_2_node
+        # node / edge indices use the narrowest type holding max(nodes_num, edges_num)
+        self.index_dtype = index_dtype(max(self.nodes_num, self.edges_num))
+        Node, Edge = trail_structs(self.index_dtype)
         self.max_size = max_size
+        self.arc_samples = arc_samples
         self.color = 0xa0a0a0
-        self.a_matrix = ti.field(dtype=ti.i8,
-                                 shape=(self.nodes_num, self.nodes_num, self.env_num),
-                                 name="adjent matrix")
+        self.adjacency = adjacency
+        self.a_matrix = None
+        if self.adjacency == "dense":
+            self.a_matrix = ti.field(dtype=ti.i8,
+                                     shape=(self.nodes_num, self.nodes_num, self.env_num),
+                                     name="adjent matrix")
         self.nodes = Node.field(shape=(self.nodes_num, 
                                        self.env_num))
         self.edges = Edge.field(shape=(self.edges_num, 
                                        self.env_num))
-        self.nodes_2_edges_s = ti.field(dtype=ti.i8,
-                                        shape=(self.nodes_num, self.max_edges_2_node, self.env_num),
+        # CSR adjacency: the out (in) edges of node i in env j are
+        # nodes_2_edges_s[nodes_2_edges_s_offset[i, j]:nodes_2_edges_s_offset[i + 1, j], j],
+        # sorted by their end (start) node index, then by edge index
+        self.nodes_2_edges_s_offset = ti.field(dtype=self.index_dtype,
+                                               shape=(self.nodes_num + 1, self.env_num),
+                                               name="offsets of egdes on nodes (out)")
+        self.nodes_2_edges_s = ti.field(dtype=self.index_dtype,
+                                        shape=(self.edges_num, self.env_num),
                                         name="index of egdes on nodes (out)")
-        self.nodes_2_edges_e = ti.field(dtype=ti.i8,
-                                        shape=(self.nodes_num, self.max_edges_2_node, self.env_num),
+        self.nodes_2_edges_e_offset = ti.field(dtype=self.index_dtype,
+                                               shape=(self.nodes_num + 1, self.env_num),
+                                               name="offsets of egdes on nodes (in)")
+        self.nodes_2_edges_e = ti.field(dtype=self.index_dtype,
+                                        shape=(self.edges_num, self.env_num),
                                         name="index of egdes on nodes (in)")
+        self.adjacency_cursor = ti.field(dtype=ti.i32,
+                                         shape=(self.nodes_num, self.env_num, 2),
+                                         name="scatter cursors of the adjacency build")
+        # arc_lut[i, j, k]: length of edge i in env j from t = 0 to t = k / arc_samples
+        self.arc_lut = ti.field(dtype=ti.f32,
+                                shape=(self.edges_num, self.env_num, self.arc_samples + 1),
+                                name="arc length tables of edges")
+        self.staging = None # host -> device staging fields, reused between loads
+        # all pairs routing tables, allocated by the first build_routes and rebuilt after the edges change:
+        # route_dist[i, t, j]: length of the shortest path from node i to node t in env j (inf if unreachable)
+        # route_next_edge[i, t, j]: first edge of that path, -1 if there is none
+        self.route_dist = None
+        self.route_next_edge = None
+        self.route_heap = None
+        self.routes_valid = False
+        # render caches of the trails, dropped whenever the trails are regenerated
+        self.version = 0
+        self.render_cache = {}
+        self.render_samples = 30
     
+    def generate_trails(self,
+                        node_pos_vector,
+                        nodes_attribute,
+                        edges_ind_s,
+                        edges_ind_e,
+                        edges_pos_s,
+                        edges_pos_e,
+                        edges_con_s,
+                        edges_con_e,
+                        edges_line_state):
+        if self.a_matrix is not None:
+            self.a_matrix.fill(0)
+        self.fill_trails(node_pos_vector, nodes_attribute, edges_ind_s, edges_ind_e,
+                         edges_pos_s, edges_pos_e, edges_con_s, edges_con_e, edges_line_state)
+        self.build_arc_tables()
+        self.build_adjacency()
+        self.routes_valid = False
+        self.version += 1
+        self.render_cache = {}
+
     @ti.kernel
-    def generate_trails(self, 
-                        node_pos_vector: ti.template(), 
-                        nodes_attribute: ti.template(),
-                        edges_ind_s: ti.template(),
-                        edges_ind_e: ti.template(),
-                        edges_pos_s: ti.template(),
-                        edges_pos_e: ti.template(),
-                        edges_con_s: ti.template(),
-                        edges_con_e: ti.template(),
-                        edges_line_state: ti.template()): 
+    def fill_trails(self, 
+                    node_pos_vector: ti.template(), 
+                    nodes_attribute: ti.template(),
+                    edges_ind_s: ti.template(),
+                    edges_ind_e: ti.template(),
+                    edges_pos_s: ti.template(),
+                    edges_pos_e: ti.template(),
+                    edges_con_s: ti.template(),
+                    edges_con_e: ti.template(),
+                    edges_line_state: ti.template()): 
         for i, j in ti.ndrange(self.nodes_num, self.env_num):
             self.nodes[i, j].idx = i
             self.nodes[i, j].pos = vec2(node_pos_vector[i, j, 0], node_pos_vector[i, j, 1])
@@ -110,17 +224,8 @@ class Trails:
             self.edges[i, j].s_node_idx = edges_ind_s[i, j]
             self.edges[i, j].e_node_idx = edges_ind_e[i, j]
             self.edges[i, j].line_state = edges_line_state[i, j]
-            self.edges[i, j].line_length = self.edges[i, j].get_line_length(1)
-            self.a_matrix[self.edges[i, j].s_node_idx, self.edges[i, j].e_node_idx, j] = 1
-
-        for i, j in ti.ndrange(self.nodes_num, self.env_num):
-            node_2_edge_s_ind = 0
-            node_2_edge_e_ind = 0
-            for k in range(self.edges_num):
-                is_start = (self.edges[k, j].s_node_idx == i)
-                self.nodes_2_edges_s[i, node_2_edge_s_ind, j] = k * (is_start) - (1 - is_start)
-                is_end =  (self.edges[k, j].e_node_idx == i)
-                self.nodes_2_edges_e[i, node_2_edge_e_ind, j] = k * (is_end) - (1 - is_end)
+            if ti.static(self.adjacency == "dense"):
+                self.a_matrix[self.edges[i, j].s_node_idx, self.edges[i, j].e_node_idx, j] = 1
 
         # check whether the index of egde start and end is the same with pos of edge start and end
         # for i, j in ti.ndrange(self.edges_num, self.env_num):
@@ -129,88 +234,380 @@ class Trails:
         #     diff_pos_e = (self.nodes[edges_ind_e[i, j], j].pos[0] - edges_pos_e[i, j, 0],
         #                   self.nodes[edges_ind_e[i, j], j].pos[1] - edges_pos_e[i, j, 1])
     
+    @ti.kernel
+    def build_arc_tables(self):
+        """ sample every edge at arc_samples + 1 points of t and store the cumulative length, set line_length """
+        for i, j in ti.ndrange(self.edges_num, self.env_num):
+            length = 0.0
+            last_point = self.edges[i, j].get_t_pos(0.0)
+            self.arc_lut[i, j, 0] = 0.0
+            for k in range(1, self.arc_samples + 1):
+                point = self.edges[i, j].get_t_pos(k / self.arc_samples)
+                length += tm.length(point - last_point)
+                last_point = point
+                self.arc_lut[i, j, k] = length
+            self.edges[i, j].line_length = length
+
+    @ti.func
+    def t_at_distance(self, i, env, s):
+        """ curve parameter t of edge i at arc length s from its start (O(log arc_samples)) """
+        length = self.edges[i, env].line_length
+        s = tm.clamp(s, 0.0, length)
+        t = 0.0
+        if self.edges[i, env].line_state >= 1.0:
+            if length > 0:
+                t = s / length
+        else:
+            lo = 0
+            hi = self.arc_samples
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if self.arc_lut[i, env, mid] <= s:
+                    lo = mid
+                else:
+                    hi = mid
+            segment = self.arc_lut[i, env, hi] - self.arc_lut[i, env, lo]
+            ratio = 0.0
+            if segment > 0:
+                ratio = (s - self.arc_lut[i, env, lo]) / segment
+            t = (lo + ratio) / self.arc_samples
+        return t
+
+    @ti.func
+    def pos_at_distance(self, i, env, s):
+        return self.edges[i, env].get_t_pos(self.t_at_distance(i, env, s))
+
+    @ti.func
+    def tangent_at_distance(self, i, env, s):
+        """ unit direction of motion on edge i at arc length s """
+        return tm.normalize(self.edges[i, env].get_t_tangent(self.t_at_distance(i, env, s)))
+
+    @ti.kernel
+    def build_adjacency(self):
+        """ build the CSR node -> edge adjacency: count degrees, prefix sum per env, scatter the edges
+            (the counting and the scatter cursors are i32, the offsets are stored with the index type)
+        """
+        for i, j in ti.ndrange(self.nodes_num, self.env_num):
+            self.adjacency_cursor[i, j, 0] = 0
+            self.adjacency_cursor[i, j, 1] = 0
+
+        for i, j in ti.ndrange(self.edges_num, self.env_num):
+            ti.atomic_add(self.adjacency_cursor[ti.cast(self.edges[i, j].s_node_idx, ti.i32), j, 0], 1)
+            ti.atomic_add(self.adjacency_cursor[ti.cast(self.edges[i, j].e_node_idx, ti.i32), j, 1], 1)
+
+        # exclusive prefix sum of the degrees, the cursors become the first slot of every node
+        for j in range(self.env_num):
+            start_s, start_e = 0, 0
+            for i in range(self.nodes_num):
+                degree_s, degree_e = self.adjacency_cursor[i, j, 0], self.adjacency_cursor[i, j, 1]
+                self.nodes_2_edges_s_offset[i, j] = ti.cast(start_s, self.index_dtype)
+                self.nodes_2_edges_e_offset[i, j] = ti.cast(start_e, self.index_dtype)
+                self.adjacency_cursor[i, j, 0] = start_s
+                self.adjacency_cursor[i, j, 1] = start_e
+                start_s += degree_s
+                start_e += degree_e
+            self.nodes_2_edges_s_offset[self.nodes_num, j] = ti.cast(start_s, self.index_dtype)
+            self.nodes_2_edges_e_offset[self.nodes_num, j] = ti.cast(start_e, self.index_dtype)
+
+        for i, j in ti.ndrange(self.edges_num, self.env_num):
+            slot_s = ti.atomic_add(self.adjacency_cursor[ti.cast(self.edges[i, j].s_node_idx, ti.i32), j, 0], 1)
+            self.nodes_2_edges_s[slot_s, j] = ti.cast(i, self.index_dtype)
+            slot_e = ti.atomic_add(self.adjacency_cursor[ti.cast(self.edges[i, j].e_node_idx, ti.i32), j, 1], 1)
+            self.nodes_2_edges_e[slot_e, j] = ti.cast(i, self.index_dtype)
+
+        # the scatter order depends on the thread schedule, sort every node's edges (degrees are small)
+        # by (other node, edge), which also makes the (s, e) pairs searchable
+        for i, j in ti.ndrange(self.nodes_num, self.env_num):
+            self.sort_edge_slice(self.nodes_2_edges_s, ti.cast(self.nodes_2_edges_s_offset[i, j], ti.i32),
+                                 ti.cast(self.nodes_2_edges_s_offset[i + 1, j], ti.i32), j, True)
+            self.sort_edge_slice(self.nodes_2_edges_e, ti.cast(self.nodes_2_edges_e_offset[i, j], ti.i32),
+                                 ti.cast(self.nodes_2_edges_e_offset[i + 1, j], ti.i32), j, False)
+
+    @ti.func
+    def other_node(self, edge, env, by_end: ti.template()):
+        node = 0
+        if ti.static(by_end):
+            node = ti.cast(self.edges[edge, env].e_node_idx, ti.i32)
+        else:
+            node = ti.cast(self.edges[edge, env].s_node_idx, ti.i32)
+        return node
+
+    @ti.func
+    def sort_edge_slice(self, edge_list: ti.template(), start, end, env, by_end: ti.template()):
+        for k in range(start + 1, end):
+            edge = ti.cast(edge_list[k, env], ti.i32)
+            node = self.other_node(edge, env, by_end)
+            m = k - 1
+            while m >= start:
+                prev_node = self.other_node(ti.cast(edge_list[m, env], ti.i32), env, by_end)
+                if prev_node < node or (prev_node == node and edge_list[m, env] < edge):
+                    break
+                edge_list[m + 1, env] = edge_list[m, env]
+                m -= 1
+            edge_list[m + 1, env] = ti.cast(edge, self.index_dtype)
+
+    @ti.func
+    def find_edge(self, s, e, env):
+        """ index of the first edge from node s to node e, -1 if they are not connected (O(log degree)) """
+        lo = ti.cast(self.nodes_2_edges_s_offset[s, env], ti.i32)
+        hi = ti.cast(self.nodes_2_edges_s_offset[s + 1, env], ti.i32)
+        end = hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.other_node(ti.cast(self.nodes_2_edges_s[mid, env], ti.i32), env, True) < e:
+                lo = mid + 1
+            else:
+                hi = mid
+        edge = -1
+        if lo < end:
+            if self.other_node(ti.cast(self.nodes_2_edges_s[lo, env], ti.i32), env, True) == e:
+                edge = ti.cast(self.nodes_2_edges_s[lo, env], ti.i32)
+        return edge
+
+    @ti.func
+    def is_connected(self, s, e, env):
+        connected = False
+        if ti.static(self.adjacency == "dense"):
+            connected = self.a_matrix[s, e, env] != 0
+        else:
+            connected = self.find_edge(s, e, env) >= 0
+        return connected
+
+    @ti.func
+    def out_degree(self, node, env):
+        return ti.cast(self.nodes_2_edges_s_offset[node + 1, env], ti.i32) - \
+               ti.cast(self.nodes_2_edges_s_offset[node, env], ti.i32)
+
+    @ti.func
+    def out_edge(self, node, k, env):
+        """ index of the k-th edge starting from node """
+        return ti.cast(self.nodes_2_edges_s[ti.cast(self.nodes_2_edges_s_offset[node, env], ti.i32) + k, env], ti.i32)
+
+    @ti.func
+    def in_degree(self, node, env):
+        return ti.cast(self.nodes_2_edges_e_offset[node + 1, env], ti.i32) - \
+               ti.cast(self.nodes_2_edges_e_offset[node, env], ti.i32)
+
+    @ti.func
+    def in_edge(self, node, k, env):
+        """ index of the k-th edge ending at node """
+        return ti.cast(self.nodes_2_edges_e[ti.cast(self.nodes_2_edges_e_offset[node, env], ti.i32) + k, env], ti.i32)
+
+    def build_routes(self, method="auto", floyd_warshall_max_nodes=256):
+        """ compute the next hop tables of every env on the device, nothing is done while they are valid
+
+            Args:
+                method: "floyd_warshall" (parallel over node pairs, nodes_num launches),
+                        "dijkstra" (one binary heap search per source node and env, for large sparse graphs)
+                        or "auto": floyd_warshall up to floyd_warshall_max_nodes nodes
+        """
+        if self.routes_valid:
+            return
+        if method == "auto":
+            method = "floyd_warshall" if self.nodes_num <= floyd_warshall_max_nodes else "dijkstra"
+        if method not in ("floyd_warshall", "dijkstra"):
+            raise ValueError(f"unknown routing method: {method}")
+        if self.route_dist is None:
+            self.route_dist = ti.field(dtype=ti.f32,
+                                       shape=(self.nodes_num, self.nodes_num, self.env_num),
+                                       name="shortest path lengths")
+            self.route_next_edge = ti.field(dtype=self.index_dtype,
+                                            shape=(self.nodes_num, self.nodes_num, self.env_num),
+                                            name="next edge of shortest paths")
+
+        if method == "floyd_warshall":
+            self.init_routes()
+            for k in range(self.nodes_num):
+                self.relax_routes(k)
+        else:
+            if self.route_heap is None:
+                # [:, :, :, 0]: heap of nodes ordered by distance, [:, :, :, 1]: slot of each node in the heap
+                self.route_heap = ti.field(dtype=ti.i32,
+                                           shape=(self.nodes_num, self.nodes_num, self.env_num, 2),
+                                           name="dijkstra heaps")
+            self.dijkstra_routes()
+        self.routes_valid = True
+
+    @ti.kernel
+    def init_routes(self):
+        for i, t, j in self.route_dist:
+            self.route_dist[i, t, j] = 0.0 if i == t else tm.inf
+            self.route_next_edge[i, t, j] = -1
+        for i, j in ti.ndrange(self.nodes_num, self.env_num):
+            for k in range(self.out_degree(i, j)):
+                edge = self.out_edge(i, k, j)
+                t = ti.cast(self.edges[edge, j].e_node_idx, ti.i32)
+                if self.edges[edge, j].line_length < self.route_dist[i, t, j]:
+                    self.route_dist[i, t, j] = self.edges[edge, j].line_length
+                    self.route_next_edge[i, t, j] = edge
+
+    @ti.kernel
+    def relax_routes(self, k: ti.i32):
+        """ Floyd-Warshall step through node k, row and column k do not change during the step """
+        for i, t, j in self.route_dist:
+            dist = self.route_dist[i, k, j] + self.route_dist[k, t, j]
+            if dist < self.route_dist[i, t, j]:
+                self.route_dist[i, t, j] = dist
+                self.route_next_edge[i, t, j] = self.route_next_edge[i, k, j]
+
+    @ti.func
+    def heap_swap(self, s, j, a, b):
+        node_a = self.route_heap[s, a, j, 0]
+        node_b = self.route_heap[s, b, j, 0]
+        self.route_heap[s, a, j, 0] = node_b
+        self.route_heap[s, b, j, 0] = node_a
+        self.route_heap[s, node_a, j, 1] = b
+        self.route_heap[s, node_b, j, 1] = a
+
+    @ti.func
+    def heap_sift_up(self, s, j, slot):
+        while slot > 0:
+            parent = (slot - 1) // 2
+            if self.route_dist[s, self.route_heap[s, parent, j, 0], j] <= self.route_dist[s, self.route_heap[s, slot, j, 0], j]:
+                break
+            self.heap_swap(s, j, slot, parent)
+            slot = parent
+
+    @ti.func
+    def heap_sift_down(self, s, j, slot, size):
+        while 2 * slot + 1 < size:
+            child = 2 * slot + 1
+            if child + 1 < size and \
+                    self.route_dist[s, self.route_heap[s, child + 1, j, 0], j] < self.route_dist[s, self.route_heap[s, child, j, 0], j]:
+                child += 1
+            if self.route_dist[s, self.route_heap[s, slot, j, 0], j] <= self.route_dist[s, self.route_heap[s, child, j, 0], j]:
+                break
+            self.heap_swap(s, j, slot, child)
+            slot = child
+
+    @ti.kernel
+    def dijkstra_routes(self):
+        for s, j in ti.ndrange(self.nodes_num, self.env_num):
+            for t in range(self.nodes_num):
+                self.route_dist[s, t, j] = tm.inf
+                self.route_next_edge[s, t, j] = -1
+                self.route_heap[s, t, j, 1] = -1
+            self.route_dist[s, s, j] = 0.0
+            self.route_heap[s, 0, j, 0] = s
+            self.route_heap[s, s, j, 1] = 0
+            size = 1
+            while size > 0:
+                u = self.route_heap[s, 0, j, 0]
+                size -= 1
+                self.heap_swap(s, j, 0, size)
+                self.heap_sift_down(s, j, 0, size)
+                for k in range(self.out_degree(u, j)):
+                    edge = self.out_edge(u, k, j)
+                    v = ti.cast(self.edges[edge, j].e_node_idx, ti.i32)
+                    dist = self.route_dist[s, u, j] + self.edges[edge, j].line_length
+                    if dist < self.route_dist[s, v, j]:
+                        self.route_dist[s, v, j] = dist
+                        self.route_next_edge[s, v, j] = edge if u == s else self.route_next_edge[s, u, j]
+                        if self.route_heap[s, v, j, 1] < 0:
+                            self.route_heap[s, size, j, 0] = v
+                            self.route_heap[s, v, j, 1] = size
+                            size += 1
+                        self.heap_sift_up(s, j, self.route_heap[s, v, j, 1])
+
+    @ti.func
+    def next_hop(self, env, node, target):
+        """ first edge of the shortest path from node to target, -1 if node == target or target is unreachable """
+        return self.route_next_edge[node, target, env]
+
     def warp_data(self):
-        all_data = {
-            "envs": [],
+        return {
+            "envs": list(self.iter_env_data()),
             "max_size": self.max_size
         }
+
+    def iter_env_data(self):
+        """ yield the nodes / edges dict of each env, every field column is copied to the host only once
+            and only the env being yielded is converted to python lists
+        """
+        nodes_columns = self.nodes.to_numpy()
+        edges_columns = self.edges.to_numpy()
         for j in range(self.env_num):
+            nodes = {key: value[:, j].tolist() for key, value in nodes_columns.items()}
+            edges = {key: value[:, j].tolist() for key, value in edges_columns.items()}
             data = {
-                "nodes": [],
-                "edges": []
+                "nodes": [
+                    {"idx": idx, "pos": pos, "attribute": attribute}
+                    for idx, pos, attribute in zip(nodes["idx"], nodes["pos"], nodes["attribute"])
+                ],
+                "edges": [
+                    {"s_node_idx": s_node_idx, "e_node_idx": e_node_idx,
+                     "s_pos": s_pos, "e_pos": e_pos,
+                     "s_con": s_con, "e_con": e_con,
+                     "line_state": line_state}
+                    for s_node_idx, e_node_idx, s_pos, e_pos, s_con, e_con, line_state in zip(
+                        edges["s_node_idx"], edges["e_node_idx"],
+                        edges["s_pos"], edges["e_pos"],
+                        edges["s_con"], edges["e_con"],
+                        edges["line_state"])
+                ]
             }
-            for i in range(self.nodes_num):
-                node_data = {
-                    "idx": self.nodes[i, j].idx,
-                    "pos": [self.nodes[i, j].pos[0], self.nodes[i, j].pos[1]],
-                    "attribute": self.nodes[i, j].attribute
-                }
-                data["nodes"].append(node_data)
-
-            for i in range(self.edges_num):
-                edge_data = {
-                    "s_node_idx": self.edges[i, j].s_node_idx,
-                    "e_node_idx": self.edges[i, j].e_node_idx,
-                    "s_pos": [self.edges[i, j].s_pos[0], self.edges[i, j].s_pos[1]],
-                    "e_pos": [self.edges[i, j].e_pos[0], self.edges[i, j].e_pos[1]],
-                    "s_con": [self.edges[i, j].s_con[0], self.edges[i, j].s_con[1]],
-                    "e_con": [self.edges[i, j].e_con[0], self.edges[i, j].e_con[1]],
-                    "line_state": self.edges[i, j].line_state
-                }
-                data["edges"].append(edge_data)
-            
-            all_data["envs"].append(data)
-        return all_data
+            yield data
     
     def extract_data(self, dict_input):
-        node_pos_vector = ti.field(dtype=ti.f32, shape=(self.nodes_num, self.env_num, 2))
-        nodes_attribute = ti.field(dtype=ti.i8, shape=(self.nodes_num, self.env_num))
-
-        edges_ind_s = ti.field(dtype=ti.i8, shape=(self.edges_num, self.env_num))
-        edges_ind_e = ti.field(dtype=ti.i8, shape=(self.edges_num, self.env_num))
-        
-        edges_pos_s = ti.field(dtype=ti.f32, shape=(self.edges_num, self.env_num, 2))
-        edges_pos_e = ti.field(dtype=ti.f32, shape=(self.edges_num, self.env_num, 2))
-        edges_con_s = ti.field(dtype=ti.f32, shape=(self.edges_num, self.env_num, 2))
-        edges_con_e = ti.field(dtype=ti.f32, shape=(self.edges_num, self.env_num, 2))
-        edges_line_state = ti.field(dtype=ti.f32, shape=(self.edges_num, self.env_num))
-
         self.max_size = dict_input["max_size"]
+        self.load_arrays(unpack_trails_data(dict_input, self.nodes_num, self.edges_num, self.env_num))
+
+    def load_arrays(self, arrays):
+        """ push the trails arrays (see unpack_trails_data) to the device and generate the trails
+
+            Args:
+                arrays: dict of numpy arrays, nodes/edges as the first axis and envs as the second one
+            Comments:
+                the staging fields are allocated on the first call and reused by the following loads
+        """
+        for name in ("edges_ind_s", "edges_ind_e"):
+            if arrays[name].size and (arrays[name].min() < 0 or arrays[name].max() >= self.nodes_num):
+                raise ValueError(f"{name} holds node indices outside [0, {self.nodes_num})")
+        if self.staging is None:
+            self.staging = {
+                "node_pos_vector": ti.field(dtype=ti.f32, shape=(self.nodes_num, self.env_num, 2)),
+                "nodes_attribute": ti.field(dtype=ti.i8, shape=(self.nodes_num, self.env_num)),
+                "edges_ind_s": ti.field(dtype=self.index_dtype, shape=(self.edges_num, self.env_num)),
+                "edges_ind_e": ti.field(dtype=self.index_dtype, shape=(self.edges_num, self.env_num)),
+                "edges_pos_s": ti.field(dtype=ti.f32, shape=(self.edges_num, self.env_num, 2)),
+                "edges_pos_e": ti.field(dtype=ti.f32, shape=(self.edges_num, self.env_num, 2)),
+                "edges_con_s": ti.field(dtype=ti.f32, shape=(self.edges_num, self.env_num, 2)),
+                "edges_con_e": ti.field(dtype=ti.f32, shape=(self.edges_num, self.env_num, 2)),
+                "edges_line_state": ti.field(dtype=ti.f32, shape=(self.edges_num, self.env_num)),
+            }
+        for name, field in self.staging.items():
+            field.from_numpy(arrays[name])
 
-        for i in range(self.env_num):
-            for j in range(self.nodes_num):
-                node_data = dict_input["envs"][i]["nodes"][j]
-                node_pos_vector[j, i, 0] = node_data["pos"][0]
-                node_pos_vector[j, i, 1] = node_data["pos"][1]
-                nodes_attribute[j, i] = node_data["attribute"]
-        
-        for i in range(self.env_num):
-            for j in range(self.edges_num):
-                edge_data = dict_input["envs"][i]["edges"][j]
-                edges_ind_s[j, i] = edge_data["s_node_idx"]
-                edges_ind_e[j, i] = edge_data["e_node_idx"]
-                edges_line_state[j, i] = edge_data["line_state"]
-                for k in range(2):
-                    edges_pos_s[j, i, k] = edge_data["s_pos"][k]
-                    edges_pos_e[j, i, k] = edge_data["e_pos"][k]
-                    edges_con_s[j, i, k] = edge_data["s_con"][k]
-                    edges_con_e[j, i, k] = edge_data["e_con"][k]
-
-        self.generate_trails(node_pos_vector, nodes_attribute, edges_ind_s, edges_ind_e,
-                             edges_pos_s, edges_pos_e, edges_con_s, edges_con_e, edges_line_state)
+        self.generate_trails(**self.staging)
             
     def save_to_yaml(self, file_name): 
         all_data = self.warp_data()
         yaml_file_name = file_name + ".yaml"
         with open(yaml_file_name, 'w') as yaml_file:
-            yaml.dump(all_data, yaml_file)
+            yaml.dump(all_data, yaml_file, Dumper=YAML_DUMPER)
     
-    def save_to_json(self, file_name): 
-        all_data = self.warp_data()
+    def save_to_json(self, file_name, compact=False): 
+        """ write the trails env by env, so only one env dict is held in memory at a time
+
+            Args:
+                file_name: file name without the ".json" suffix
+                compact: drop the indentation and the spaces after separators
+        """
         json_file_name = file_name + ".json"
+        if compact:
+            dump_args = {"separators": (",", ":"), "sort_keys": True}
+            head, sep, tail = '{"envs":[', ',', '],"max_size":%s}' % json.dumps(self.max_size)
+        else:
+            dump_args = {"indent": 2, "sort_keys": True}
+            head, sep, tail = '{\n  "envs": [\n', ',\n', '\n  ],\n  "max_size": %s\n}' % json.dumps(self.max_size)
         with open(json_file_name, 'w') as json_file:
-            json.dump(all_data, json_file,
-                      indent=2, sort_keys=True)
+            json_file.write(head)
+            for j, data in enumerate(self.iter_env_data()):
+                env_text = json.dumps(data, **dump_args)
+                if not compact:
+                    env_text = textwrap.indent(env_text, "    ")
+                json_file.write(sep * (j > 0) + env_text)
+            json_file.write(tail)
 
     def load_from_yaml(self, file_name):
         with open(file_name, 'r') as yaml_file:
@@ -222,32 +619,64 @@ class Trails:
             data = json.load(json_file)
         self.extract_data(data)  
 
+    def load_from_scenario(self, file_name):
+        """ load the trails from a compiled scenario file (see scenario.compile_scenario) """
+        self.load_from_arrays(*read_scenario(file_name), source=file_name)
+
+    def load_from_arrays(self, header, arrays, source="scenario"):
+        """ load the trails from a scenario header and its arrays (memory mapped, shared memory ...) """
+        if header.get("nodes_num", 0) < self.nodes_num or header.get("edges_num", 0) < self.edges_num \
+                or header.get("env_num", 0) < self.env_num:
+            raise ValueError(f"{source} does not hold {self.nodes_num} nodes, "
+                             f"{self.edges_num} edges and {self.env_num} envs")
+        self.max_size = header["trails_max_size"]
+        sizes = {"node": self.nodes_num, "edge": self.edges_num}
+        self.load_arrays({name: crop_array(arrays[name], sizes[name[:4]], self.env_num) for name in TRAILS_ARRAYS})
+
+    def snapshot(self):
+        """ copy of the full state of the fields and counters (see snapshot.capture_state) """
+        return capture_state(self)
+
+    def restore(self, state):
+        """ restore a state of snapshot / snapshot.read_state """
+        restore_state(self, state)
+
+    def restored(self):
+        # lazily built tables that were not restored are rebuilt, render caches are dropped
+        if self.route_dist is None:
+            self.routes_valid = False
+        self.version += 1
+        self.render_cache = {}
+
     def render(self, gui, env_idx=0):
-        centers = self.nodes.pos.to_numpy()[:, env_idx, :]
-        centers /= self.max_size
+        # the node centers and edge polylines of an env are pulled from the device once and cached
+        if env_idx not in self.render_cache:
+            points = np.zeros((self.edges_num, self.render_samples + 1, 2), dtype=np.float32)
+            if self.edges_num > 0:
+                self.sample_edge_points(points, env_idx)
+            points /= self.max_size
+            centers = self.nodes.pos.to_numpy()[:, env_idx, :] / self.max_size
+            self.render_cache[env_idx] = (centers,
+                                          points[:, :-1].reshape(-1, 2).copy(),
+                                          points[:, 1:].reshape(-1, 2).copy())
+        centers, begin, end = self.render_cache[env_idx]
         gui.circles(centers, color=self.color, radius=6)
+        gui.lines(begin, end, color=self.color)
 
-        # suppose that all the edges are direct lines
-        s_pos = self.edges.s_pos.to_numpy()[:, env_idx] / self.max_size
-        e_pos = self.edges.e_pos.to_numpy()[:, env_idx] / self.max_size
-        gui.lines(s_pos, e_pos, color=self.color)
-
-        # if not, please use this code
-        # for i in range(self.edges_num):
-        #     if self.edges[i, env_idx].line_state == 0:  # Bezier line
-        #         t_values = np.linspace(0, 1, num=30)
-        #         points = np.array([self.edges[i, env_idx].get_t_pos(t) for t in t_values])
-        #         # gui.circles(points, color=0x000000, radius=3)
-        #         for k in range(len(points) - 1):
-        #             gui.line(points[k], points[k + 1], color=self.color)
-        #     else:  # Direct line
-        #         s_pos = self.edges[i, env_idx].s_pos / self.max_size
-        #         e_pos = self.edges[i, env_idx].e_pos / self.max_size
-        #         gui.line(s_pos, e_pos, color=self.color)
+    @ti.kernel
+    def sample_edge_points(self, points: ti.types.ndarray(), env_idx: ti.i32):
+        """ points[i, s]: position of edge i at t = s / samples (bezier and direct lines) """
+        for i, s in ti.ndrange(points.shape[0], points.shape[1]):
+            pos = self.edges[i, env_idx].get_t_pos(s / (points.shape[1] - 1))
+            points[i, s, 0] = pos[0]
+            points[i, s, 1] = pos[1]
 
 
 @ti.data_oriented
 class Static_maps:
+    # render state left out of snapshots
+    snapshot_exclude = ("rgb_canvas", "layer")
+
     def __init__(self, 
                  grid_n,
                  nodes_num,
@@ -255,22 +684,36 @@ class Static_maps:
                  env_num,
                  static_maps_settings_file,
                  trails_settings_file,
-                 img_size=540):
+                 img_size=540,
+                 chunk_rows=None,
+                 layout="agent_major_aos",
+                 mip_levels=0,
+                 scenario=None):
+        """
+            Args:
+                scenario: optional (header, arrays) of a loaded scenario (see scenario.read_scenario), used
+                          instead of the settings files, e.g. arrays attached from shared memory
+        """
         self.grid_n = grid_n # n columns * n rows
         self.grid_length = 1.0
         self.max_size = self.grid_n * self.grid_length
         self.env_num = env_num
         self.static_maps_settings = static_maps_settings_file
         self.trails_settings = trails_settings_file
+        self.scenario = scenario
         self.img_size = img_size
+        self.chunk_rows = chunk_rows # rows of the grid pushed per copy, None: the whole grid at once
         
-        self.field_map = ti.field(dtype=ti.u8,
-                                  shape=(self.grid_n, self.grid_n, self.env_num),
-                                  name="static field maps")
-        # self.canvas = ti.field(dtype=ti.u8, shape=(self.grid_n, self.grid_n))
-        self.canvas = ti.field(dtype=ti.u8, shape=(self.img_size, self.img_size),
-                               name="canvas field for plot")
-        self.canvas.fill(0)
+        self.layout = layout # only the env_major part of field_layout.LAYOUTS applies to the maps
+        self.field_map = place_field(ti.u8, (self.grid_n, self.grid_n, self.env_num),
+                                     LAYOUTS[self.layout]["env_major"], name="static field maps")
+        # optional 2x downsampled levels of field_map for wide area sensing (sensors.MapSensor.sample_area)
+        self.pyramid = MipPyramid(self.grid_n, self.env_num, mip_levels,
+                                  LAYOUTS[self.layout]["env_major"]) if mip_levels > 0 else None
+        # rgb canvas shown by render, composed from the cached static layer (map + trails) of the shown env
+        self.rgb_canvas = ti.Vector.field(3, dtype=ti.u8, shape=(self.img_size, self.img_size),
+                                          name="rgb canvas field for plot")
+        self.layer = None
 
         self.width = self.grid_n * self.grid_length
         self.height = self.grid_n * self.grid_length
@@ -280,49 +723,80 @@ class Static_maps:
         self.generate_field()      
     
     def generate_field(self):
-        if self.static_maps_settings[-4:] == "json":
-            with open(self.static_maps_settings, 'r') as json_file:
-                data = json.load(json_file)
-        elif self.static_maps_settings[-4:] == "yaml":
-            with open(self.static_maps_settings, 'r') as yaml_file:
-                data = yaml.load(yaml_file, Loader=yaml.FullLoader)
-        if data is None:
-            raise Exception
+        if self.scenario is not None:
+            header, arrays = self.scenario
+            data_maps = arrays["field_map"]
+        elif is_scenario_file(self.static_maps_settings):
+            header, arrays = read_scenario(self.static_maps_settings)
+            data_maps = arrays["field_map"]
+        else:
+            header = load_settings(self.static_maps_settings)
+            data_maps = np.asarray(header.pop("maps"), dtype=np.uint8)
+        self.grid_n = header["grid_n"]
+        self.max_size = header["max_size"]
+        self.grid_length = self.max_size / self.grid_n
+
+        if data_maps.ndim != 3 or data_maps.shape[:2] != self.field_map.shape[:2] \
+                or data_maps.shape[2] < self.env_num:
+            raise ValueError(f"maps of shape {data_maps.shape} in {self.static_maps_settings} "
+                             f"do not fit the field map of shape {self.field_map.shape}")
+        if self.chunk_rows is None:
+            self.field_map.from_numpy(crop_array(data_maps, self.grid_n, self.env_num, 2))
         else:
-            self.grid_n = data["grid_n"]
-            self.max_size = data["max_size"]
-            self.grid_length = self.max_size / self.grid_n
-            data_maps = data["maps"]
-            for i, j, k in ti.ndrange(self.grid_n, self.grid_n, self.env_num):
-                self.field_map[i, j, k] = data_maps[i][j][k]
-
-        if self.trails_settings[-4:] == "json":
+            # rows are only read from disk chunk by chunk for memory mapped (compiled) maps
+            for row_start in range(0, self.grid_n, self.chunk_rows):
+                rows = data_maps[row_start:row_start + self.chunk_rows, :, :self.env_num]
+                self.store_rows(np.ascontiguousarray(rows), row_start)
+        if self.pyramid is not None:
+            self.pyramid.update(self.field_map)
+        if self.layer is not None:
+            self.layer.invalidate()
+
+        if self.scenario is not None:
+            self.trails.load_from_arrays(*self.scenario)
+        elif is_scenario_file(self.trails_settings):
+            self.trails.load_from_scenario(self.trails_settings)
+        elif self.trails_settings[-4:] == "json":
             self.trails.load_from_json(self.trails_settings)
         elif self.trails_settings[-4:] == "yaml":
             self.trails.load_from_yaml(self.trails_settings)
         
     
-    @ti.kernel
-    def interact_with_borad(self):
-        pass
+    def snapshot(self):
+        """ copy of the full state of the fields and counters (see snapshot.capture_state) """
+        return capture_state(self)
+
+    def restore(self, state):
+        """ restore a state of snapshot / snapshot.read_state """
+        restore_state(self, state)
+
+    def restored(self):
+        if self.layer is not None:
+            self.layer.invalidate()
 
     @ti.kernel
-    def plot_maps_2_canvas(self, env_idx: int):
-        # for x, y in ti.ndrange(self.grid_n, self.grid_n):
-            # self.canvas[x, y] = self.field_map[x, y, env_idx] / 255
-        for x, y in ti.ndrange(self.img_size, self.img_size):
-            field_x = (x * self.grid_n) // self.img_size
-            field_y = (y * self.grid_n) // self.img_size
-            self.canvas[x, y] = self.field_map[field_x, field_y, env_idx]
+    def store_rows(self, rows: ti.types.ndarray(), row_start: int):
+        for i, j, k in ti.ndrange(rows.shape[0], rows.shape[1], rows.shape[2]):
+            self.field_map[row_start + i, j, k] = rows[i, j, k]
 
+    @ti.kernel
+    def interact_with_borad(self):
+        pass
 
-    def render(self, gui, env_idx=0):
-        # window_width, window_height = gui.res
-        # self.plot_maps_2_canvas(env_idx)
-        interpolation(self.canvas, self.field_map, env_idx, bilinear=0)
-        # gui.contour(self.canvas, normalize=True)
-        gui.set_image(self.canvas.to_numpy())
-        self.trails.render(gui, env_idx)
+    def render(self, gui, env_idx=0, dynamic_maps=None, field_max=1.0, field_color=0xff0000):
+        """ show env env_idx, the map and the trails are rasterized once per env (see renderer.StaticLayer),
+            only the dynamic overlay is drawn every frame
+
+            Args:
+                dynamic_maps: Dynamic_maps whose field_map is blended in field_color, saturated at field_max
+        """
+        if self.layer is None:
+            self.layer = StaticLayer(self, (self.img_size, self.img_size), trails_color=self.trails.color)
+        self.layer.to_canvas(self.layer.update(), self.rgb_canvas, env_idx)
+        if dynamic_maps is not None:
+            self.layer.blend_canvas(self.rgb_canvas, dynamic_maps.field_map, env_idx, 1.0 / field_max,
+                                    rgb(field_color))
+        gui.set_image(self.rgb_canvas)
 
 
 if __name__ == "__main__":
@@ -164,9 +164,15 @@ def test_maps(filename_maps, filename_trail):
     gui = ti.GUI("flocking behavior", 
                  res=(WINDOW_WIDTH, WINDOW_HEIGHT),
                  show_gui=True)
+    # left / right arrows switch the shown env, the layer of each env is only rasterized once
+    env_idx = 0
     while gui.running:
-        gui.clear(0xffffff)
-        maps.render(gui, 0)
+        for e in gui.get_events(ti.GUI.PRESS):
+            if e.key == ti.GUI.RIGHT:
+                env_idx = (env_idx + 1) % env_num
+            elif e.key == ti.GUI.LEFT:
+                env_idx = (env_idx - 1) % env_num
+        maps.render(gui, env_idx)
         gui.show()
 
 
@@ -0,0 +1,200 @@
+import taichi as ti
+import taichi.math as tm
+import numpy as np
+
+import os
+import sys
+
+# Get the parent directory of the current script
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+
+# Add the parent directory to the Python path
+sys.path.append(parent_directory)
+
+from utils.utils import vec2
+from Agent import SwarmAgents, hash_uniform
+from sensors import sample_bilinear
+
+REWARDS = ("polarization", "map")
+# obs of an agent: pos / simulation_size, vel / max_spd, then the sensed value and gradient when there are maps
+OBS_DIM = 4
+MAP_OBS_DIM = 3
+
+
+@ti.data_oriented
+class FlockingVecEnv:
+    def __init__(self,
+                 num_envs,
+                 free_n,
+                 maps=None,
+                 episode_length=200,
+                 dt=0.01,
+                 action_scale=1.0,
+                 reward="polarization",
+                 auto_reset=True,
+                 seed=0,
+                 **swarm_args):
+        """ num_envs flocking envs stepped together, every free agent is controlled by an acceleration action
+
+            Args:
+                maps: optional Static_maps / Dynamic_maps with env_num == num_envs, sensed by the agents
+                      (bilinear value and gradient at their position, see sensors.sample_bilinear)
+                action_scale: actions are multiplied by it and added to the flocking rules
+                reward: "polarization": |sum of velocities| / sum of speeds of an env,
+                        "map": mean map value sensed by the agents of an env
+                auto_reset: envs that reach episode_length are reset on the device at the end of step
+                swarm_args: forwarded to SwarmAgents (max_spd, max_acc, radii, simulation_size ...),
+                            simulation_size defaults to maps.max_size and must match it when given
+            Comments:
+                obs (num_envs, free_n, obs_dim), rewards (num_envs,) and dones (num_envs,) are numpy arrays
+                allocated once and written in place by the kernels, the returned arrays are overwritten
+                by the next reset / step
+        """
+        if reward not in REWARDS:
+            raise ValueError(f"unknown reward: {reward}")
+        if reward == "map" and maps is None:
+            raise ValueError("the map reward needs maps")
+        if maps is not None and maps.field_map.shape[2] != num_envs:
+            raise ValueError(f"maps have {maps.field_map.shape[2]} envs, {num_envs} required")
+        if maps is not None:
+            swarm_args.setdefault("simulation_size", maps.max_size)
+            if swarm_args["simulation_size"] != maps.max_size:
+                raise ValueError(f"simulation_size {swarm_args['simulation_size']} does not match "
+                                 f"the maps size {maps.max_size}")
+        self.num_envs = num_envs
+        self.free_n = free_n
+        self.maps = maps
+        self.use_maps = maps is not None
+        self.episode_length = episode_length
+        self.dt = dt
+        self.action_scale = action_scale
+        self.reward = reward
+        self.auto_reset = auto_reset
+        self.seed = seed
+        swarm_args.setdefault("max_spd", 1.0)
+        swarm_args.setdefault("max_acc", 1.0)
+        self.swarm = SwarmAgents(free_n, num_envs=num_envs, seed=seed, external_acc=True, **swarm_args)
+
+        self.obs_dim = OBS_DIM + (MAP_OBS_DIM if self.use_maps else 0)
+        self.obs = np.zeros((self.num_envs, self.free_n, self.obs_dim), dtype=np.float32)
+        self.rewards = np.zeros(self.num_envs, dtype=np.float32)
+        self.dones = np.zeros(self.num_envs, dtype=np.uint8)
+
+        self.env_steps = ti.field(dtype=ti.i32, shape=(self.num_envs,), name="steps of the running episodes")
+        self.episodes = ti.field(dtype=ti.i32, shape=(self.num_envs,), name="episode count of envs")
+        self.env_done = ti.field(dtype=ti.i32, shape=(self.num_envs,), name="envs done in the last step")
+        # reward sums of envs, [:, 0]: sum of velocities, [:, 1]: sum of speeds, [:, 2]: sum of sensed values
+        self.reward_sums = ti.Vector.field(3, dtype=ti.f32, shape=(self.num_envs,), name="reward sums of envs")
+
+    def reset(self, env_mask=None):
+        """ start a new episode in the envs of env_mask (bool array of shape (num_envs,), all envs when None)
+
+            Returns:
+                obs
+        """
+        mask = np.ones(self.num_envs, dtype=np.uint8) if env_mask is None \
+            else np.ascontiguousarray(env_mask, dtype=np.uint8)
+        if mask.shape != (self.num_envs,):
+            raise ValueError(f"env_mask of shape {mask.shape}, ({self.num_envs},) required")
+        self.reset_envs(self.swarm.free_agents, self.maps_field(), mask, self.obs)
+        return self.obs
+
+    def step(self, actions):
+        """ apply the actions (num_envs, free_n, 2), advance all envs by dt
+
+            Returns:
+                obs, rewards, dones (the obs of done envs are the first obs of their next episode
+                when auto_reset is set)
+            Comments:
+                4 kernel launches: action upload, neighbour grid, fused flocking step (which adds the
+                uploaded external_acc) and rewards / dones / resets / obs
+        """
+        actions = np.ascontiguousarray(actions, dtype=np.float32)
+        if actions.shape != (self.num_envs, self.free_n, 2):
+            raise ValueError(f"actions of shape {actions.shape}, {(self.num_envs, self.free_n, 2)} required")
+        self.load_actions(actions)
+        self.swarm.step(self.dt)
+        self.finish_step(self.swarm.free_agents, self.maps_field(), self.obs, self.rewards, self.dones)
+        return self.obs, self.rewards, self.dones
+
+    def maps_field(self):
+        # read at every call, double buffered maps swap their field_map
+        return self.maps.field_map if self.use_maps else self.env_steps
+
+    @ti.kernel
+    def load_actions(self, actions: ti.types.ndarray()):
+        for j, i in ti.ndrange(self.num_envs, self.free_n):
+            self.swarm.external_acc[i, j] = vec2(actions[j, i, 0], actions[j, i, 1]) * self.action_scale
+
+    @ti.func
+    def respawn(self, agents: ti.template(), i, j):
+        """ new random position and velocity of agent i of env j, drawn from the env's episode count """
+        agent = agents[i, j]
+        seed = self.seed + self.episodes[j] * 7919
+        agent.pos = vec2(hash_uniform(seed, i, j, 0), hash_uniform(seed, i, j, 1)) * self.swarm.simulation_size
+        angle = 2 * tm.pi * hash_uniform(seed, i, j, 2)
+        agent.vel = vec2(ti.cos(angle), ti.sin(angle)) * agent.max_spd * hash_uniform(seed, i, j, 3)
+        agent.acc = vec2(0.0)
+        agents[i, j] = agent
+
+    @ti.func
+    def write_obs(self, agents: ti.template(), field: ti.template(), obs: ti.template()):
+        for j, i in ti.ndrange(self.num_envs, self.free_n):
+            agent = agents[i, j]
+            pos = agent.pos / self.swarm.simulation_size
+            vel = agent.vel / ti.max(agent.max_spd, 1e-6)
+            obs[j, i, 0] = pos[0]
+            obs[j, i, 1] = pos[1]
+            obs[j, i, 2] = vel[0]
+            obs[j, i, 3] = vel[1]
+            if ti.static(self.use_maps):
+                value, grad = sample_bilinear(field, agent.pos, j, self.maps.grid_length)
+                obs[j, i, 4] = value
+                obs[j, i, 5] = grad[0]
+                obs[j, i, 6] = grad[1]
+
+    @ti.kernel
+    def reset_envs(self, agents: ti.template(), field: ti.template(), mask: ti.types.ndarray(),
+                   obs: ti.types.ndarray()):
+        for j in range(self.num_envs):
+            if mask[j]:
+                self.episodes[j] += 1
+                self.env_steps[j] = 0
+        for j, i in ti.ndrange(self.num_envs, self.free_n):
+            if mask[j]:
+                self.respawn(agents, i, j)
+        self.write_obs(agents, field, obs)
+
+    @ti.kernel
+    def finish_step(self, agents: ti.template(), field: ti.template(), obs: ti.types.ndarray(),
+                    rewards: ti.types.ndarray(), dones: ti.types.ndarray()):
+        # top level loops run one after the other: rewards, dones, resets of the done envs, then obs
+        for j in range(self.num_envs):
+            self.env_steps[j] += 1
+            self.reward_sums[j] = ti.Vector([0.0, 0.0, 0.0])
+        for j, i in ti.ndrange(self.num_envs, self.free_n):
+            agent = agents[i, j]
+            if ti.static(self.reward == "polarization"):
+                self.reward_sums[j] += ti.Vector([agent.vel[0], agent.vel[1], agent.vel.norm()])
+            else:
+                value, _ = sample_bilinear(field, agent.pos, j, self.maps.grid_length)
+                self.reward_sums[j][2] += value
+        for j in range(self.num_envs):
+            sums = self.reward_sums[j]
+            if ti.static(self.reward == "polarization"):
+                rewards[j] = vec2(sums[0], sums[1]).norm() / ti.max(sums[2], 1e-6)
+            else:
+                rewards[j] = sums[2] / self.free_n
+            done = self.env_steps[j] >= self.episode_length
+            dones[j] = ti.cast(done, ti.u8)
+            self.env_done[j] = ti.cast(done, ti.i32)
+            if ti.static(self.auto_reset):
+                if done:
+                    self.episodes[j] += 1
+                    self.env_steps[j] = 0
+        if ti.static(self.auto_reset):
+            for j, i in ti.ndrange(self.num_envs, self.free_n):
+                if self.env_done[j]:
+                    self.respawn(agents, i, j)
+        self.write_obs(agents, field, obs)